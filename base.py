@@ -2,9 +2,13 @@
 """
 The Base Module where all Classes used by multiple Daemons are specified
 """
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timedelta
 import html
 import os
 import socket
+import threading
+import weakref
 
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -17,11 +21,17 @@ logger = logging.getLogger(__name__)
 
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 # noinspection PyPep8
-from sqlalchemy import Column, Integer, String, ForeignKey, UniqueConstraint, and_, DateTime, Boolean, BigInteger, Unicode
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, Integer, String, ForeignKey, UniqueConstraint, and_, DateTime, Boolean, BigInteger, \
+    Unicode, literal, null, Index, event, select, func, or_, update
+from sqlalchemy.orm import relationship, backref, Session
 
 Base = declarative_base()
 
+Child = namedtuple('Child', ['type', 'id', 'name', 'hash', 'size', 'mtime'])
+
+# The name this host is registered under, main sets it from the hostname attribute of the config
+LOCAL_HOSTNAME = socket.gethostname()
+
 
 class DBObject(object):
     """
@@ -55,6 +65,26 @@ class DBObject(object):
         logger.debug('Restored Object from Database: %r' % obj)
         return obj
 
+    @classmethod
+    def existing_ids(cls, obj_ids, session):
+        """
+        @param obj_ids: ids in the database table
+        @param session: The Session used for Querying
+        @return: set of the ids that still exist
+        """
+        return set(_ids_in(session, cls.id, cls.id, list(obj_ids)))
+
+    @classmethod
+    def delete_by_ids(cls, obj_ids, session):
+        """
+        Deletes all objects with the given ids with one statement per chunk of ids, bypassing the orm
+        @param obj_ids: ids in the database table
+        @param session: The Session used for Querying
+        """
+        obj_ids = list(obj_ids)
+        for offset in range(0, len(obj_ids), _IN_CHUNK):
+            session.query(cls).filter(cls.id.in_(obj_ids[offset:offset + _IN_CHUNK])).delete(synchronize_session=False)
+
 
 class FilesystemObject(DBObject):
     """
@@ -125,9 +155,9 @@ class Host(Base, DBObject):
     @property
     def is_local(self):
         """
-        @return: True if the hostname is the local one
+        @return: True if the hostname is the local one, see LOCAL_HOSTNAME
         """
-        if socket.gethostname() != self.name:
+        if LOCAL_HOSTNAME != self.name:
             return False
         return True
 
@@ -157,36 +187,32 @@ class Host(Base, DBObject):
 
     def descendant_by_path(self, path, session):
         """
-        This will try to find the root closets to the target,
-        if it didn't find a valid root, it will try to create one,
-        witch will fail if path is not local.
+        Resolves a path with a single indexed query on the materialized path columns,
+        folders are remembered in PATH_INDEX.
         @param session: The Session used for Querying
         @param path: the path you're looking for
         @return: the FilesystemObject you're looking for
+        @raise NoResultFound: if there is no object with this path
         """
-        best = None
-        best_score = 0
-        for root in self.roots:
-            if root.name == path:
-                return root
-            score = _matching_chars(path, root.path)
-            if score > best_score:
-                best = root
-                best_score = score
-
-        if best is None:
-            raise NoResultFound('%s is not in a valid root of %s' % (path, self))
-
-        rel_path = path[len(best.path):]
-        while best.path != path and rel_path is not None and rel_path != os.sep and rel_path != '':
-            if os.sep in rel_path:
-                name, rel_path = tuple(rel_path.split(sep=os.sep, maxsplit=1))
-            else:
-                name, rel_path = rel_path, None
-            best = best.child_by_name(name, session=session)
-            if best is None:
-                raise NoResultFound('%s is not in %s' % (path, self))
-        return best
+        folder_path = '%s%s' % (path.rstrip(os.sep), os.sep)
+        folder_id = PATH_INDEX.get(self.id, folder_path)
+        if folder_id is not None:
+            folder = session.query(Folder).get(folder_id)
+            if folder is not None and folder.host_id == self.id and folder.path == folder_path:
+                return folder
+            PATH_INDEX.invalidate_ids((folder_id, ))
+
+        obj = session.query(Folder).filter(and_(Folder.host_id == self.id, Folder.path == folder_path)).first()
+        if obj is not None:
+            PATH_INDEX.put(self.id, folder_path, obj.id)
+            return obj
+
+        if not path.endswith(os.sep):
+            for cls in (File, HashRequest):
+                obj = session.query(cls).filter(and_(cls.host_id == self.id, cls.path == path)).first()
+                if obj is not None:
+                    return obj
+        raise NoResultFound('%s is not in %s' % (path, self))
 
     def __str__(self):
         return self.name
@@ -226,7 +252,7 @@ class Host(Base, DBObject):
             and_(Folder.name == path, Folder.host_id == self.id, Folder.parent_id == None)).first()
         if old_root is None:
             raise AttributeError('%s doesnt exist' % path)
-        old_root.delete()
+        Folder.delete_by_ids((old_root.id, ), session)
 
 
 class Folder(Base, FilesystemObject):
@@ -235,10 +261,15 @@ class Folder(Base, FilesystemObject):
     """
     __table_args__ = (
         UniqueConstraint('parent_id', 'host_id', 'name'),
+        Index('ix_folder_host_path', 'host_id', 'path'),
     )
     #id is the same in baseclass but for some reason strange things are happening, so we need this
     id = Column(Integer, primary_key=True)
     name = Column(Unicode, nullable=False)
+    # the absolute path, honorees the local path separator, maintained by _set_path and Folder.move
+    path = Column(Unicode, nullable=False)
+    # the mtime of the directory when it was listed the last time, None if it was never listed
+    mtime = Column(DateTime)
 
     host_id = Column(Integer, ForeignKey('host.id'), nullable=False)
     host = relationship('Host', cascade='all')
@@ -247,15 +278,6 @@ class Folder(Base, FilesystemObject):
     parent = relationship('Folder', remote_side=[id, host_id], backref=backref('folders', lazy='subquery'),
                           cascade='all, delete', lazy='subquery')
 
-    @property
-    def path(self):
-        """
-        @return: the path, honorees the local path separator
-        """
-        if None is self.parent:
-            return self.name
-        return '%s%s%s' % (self.parent.path, restore_utf8(self.name), os.sep)
-
     @property
     def uri(self):
         """
@@ -291,13 +313,14 @@ class Folder(Base, FilesystemObject):
         logger.debug('Created new Object: %r' % folder)
         return folder
 
-    def add_file(self, name, fhash, mtime, size):
+    def add_file(self, name, fhash, mtime, size, algorithm='md5'):
         """
         Creates a File as child of the object
         @param size: Integer in Byte
         @param mtime: datetime.datetime
-        @param fhash: hexdigested md5 hash
+        @param fhash: hexdigested hash
         @param name: the name of the File
+        @param algorithm: the identifier of the algorithm fhash was computed with
         @return: the new created File
         """
         if fhash is None:
@@ -305,25 +328,39 @@ class Folder(Base, FilesystemObject):
             logger.debug('Created Hash Request for %s' % request)
             return request
         else:
-            file = File(folder=self, name=name, hash=fhash, mtime=mtime, size=size, host=self.host)
+            file = File(folder=self, name=name, hash=fhash, algorithm=algorithm, mtime=mtime, size=size,
+                        host=self.host)
             logger.debug('Created new Object: %r' % file)
             return file
 
+    def move(self, parent, name, session):
+        """
+        Moves the folder and updates the materialized paths of everything below it
+        @param parent: the new parent Folder
+        @param name: the new name
+        @param session: The Session used for Querying
+        """
+        old_path = self.path
+        new_path = '%s%s%s' % (parent.path, restore_utf8(name), os.sep)
+        for cls in (Folder, File, HashRequest):
+            query = session.query(cls).filter(
+                and_(cls.host_id == self.host_id, cls.path.startswith(old_path, autoescape=True)))
+            query.update({cls.path: literal(new_path, Unicode) + func.substr(cls.path, len(old_path) + 1)},
+                         synchronize_session=False)
+        self.parent = parent
+        self.name = name
+        self.path = new_path
+        PATH_INDEX.invalidate_path(self.host_id, old_path)
+        logger.debug('Moved %s to %s' % (old_path, new_path))
+
     def child_by_name(self, name, session, eager=False):
         """
         @param session: The Session used for Querying
         @param name: the name
         @param eager: Ignored for now
-        @return: The File or folder
+        @return: The File, Folder or HashRequest
         """
-        obj = session.query(File).filter(and_(File.name == name, File.folder_id == self.id)).with_lockmode(None).first()
-        if None is obj:
-            obj = session.query(Folder).filter(
-                and_(Folder.name == name, Folder.parent_id == self.id)).with_lockmode(None).first()
-
-        if None is obj:
-            obj = session.query(HashRequest).filter(
-                and_(HashRequest.name == name, HashRequest.folder_id == self.id)).with_lockmode(None).first()
+        obj = self.children_by_name((name, ), session).get(name)
 
         if obj is not None:
             pass  # logger.debug('Restored Object from Database: %r' % obj)
@@ -332,6 +369,97 @@ class Folder(Base, FilesystemObject):
 
         return obj
 
+    def children_by_name(self, names, session):
+        """
+        Batched version of child_by_name, the names are resolved with a single UNION query
+        and the matching objects are loaded with one query per type.
+        @param names: the names you're looking for
+        @param session: The Session used for Querying
+        @return: dict name -> File, Folder or HashRequest, names that were not found are missing
+        """
+        ids = dict()
+        for child in self.children(session, names).values():
+            ids.setdefault(CHILD_TYPES[child.type], list()).append(child.id)
+
+        result = dict()
+        for cls, obj_ids in ids.items():
+            for offset in range(0, len(obj_ids), _IN_CHUNK):
+                query = session.query(cls).filter(cls.id.in_(obj_ids[offset:offset + _IN_CHUNK]))
+                result.update((obj.name, obj) for obj in query)
+        return result
+
+    def children(self, session, names=None):
+        """
+        Loads the Files, Folders and HashRequests directly below this folder with a single query
+        @param session: The Session used for Querying
+        @param names: only load children with one of these names, None loads all of them
+        @return: dict name -> Child(type, id, name, hash, size, mtime), type is one of 'file', 'folder' or 'request'
+        """
+        result = dict()
+        if names is None:
+            queries = (self._children_query(session), )
+        else:
+            names = list(names)
+            queries = (self._children_query(session, names[offset:offset + _IN_CHUNK])
+                       for offset in range(0, len(names), _IN_CHUNK))
+        for query in queries:
+            for row in query:
+                result.setdefault(row[2], Child(*row))
+        return result
+
+    def _children_query(self, session, names=None):
+        """
+        @param session: The Session used for Querying
+        @param names: optional list of names the children are filtered by
+        @return: a UNION query over the Files, Folders and HashRequests below this folder
+        """
+        files = session.query(literal('file'), File.id, File.name, File.hash, File.size, File.mtime).filter(
+            File.folder_id == self.id)
+        folders = session.query(literal('folder'), Folder.id, Folder.name, null(), null(), null()).filter(
+            Folder.parent_id == self.id)
+        requests = session.query(literal('request'), HashRequest.id, HashRequest.name, null(), HashRequest.size,
+                                 HashRequest.mtime).filter(HashRequest.folder_id == self.id)
+        if names is not None:
+            files = files.filter(File.name.in_(names))
+            folders = folders.filter(Folder.name.in_(names))
+            requests = requests.filter(HashRequest.name.in_(names))
+        return files.union_all(folders, requests)
+
+    @classmethod
+    def delete_by_ids(cls, obj_ids, session):
+        """
+        Deletes the folders with the given ids including everything below them
+        @param obj_ids: ids of the folders
+        @param session: The Session used for Querying
+        """
+        level = list(obj_ids)
+        tree = list()
+        while level:
+            tree += level
+            level = _ids_in(session, Folder.id, Folder.parent_id, level)
+        if not tree:
+            return
+        HashRequest.delete_by_ids(_ids_in(session, HashRequest.id, HashRequest.folder_id, tree), session)
+        File.delete_by_ids(_ids_in(session, File.id, File.folder_id, tree), session)
+        # the deepest folders first, a chunk never holds the parent of a folder that still exists
+        super().delete_by_ids(tree[::-1], session)
+        PATH_INDEX.invalidate_ids(tree)
+        for observer in list(FOLDER_OBSERVERS):
+            observer.forget_folders(tree)
+
+    @classmethod
+    def set_mtime(cls, obj_ids, mtime, session):
+        """
+        Sets the mtime of the folders with the given ids with one statement per chunk of ids, bypassing the orm,
+        ids of folders that do not exist anymore are ignored
+        @param obj_ids: ids of the folders
+        @param mtime: the new mtime
+        @param session: The Session used for Querying
+        """
+        obj_ids = list(obj_ids)
+        for offset in range(0, len(obj_ids), _IN_CHUNK):
+            session.execute(update(cls).where(cls.id.in_(obj_ids[offset:offset + _IN_CHUNK])).values(mtime=mtime))
+
 
 class File(Base, FilesystemObject):
     """
@@ -339,11 +467,16 @@ class File(Base, FilesystemObject):
     """
     __table_args__ = (
         UniqueConstraint('folder_id', 'host_id', 'name'),
+        Index('ix_file_host_path', 'host_id', 'path'),
+        Index('ix_file_host_hash', 'host_id', 'algorithm', 'hash'),
     )
     #id is the same in baseclass but for some reason strange things are happening, so we need this
     id = Column(Integer, primary_key=True)
     name = Column(Unicode, nullable=False)
+    path = Column(Unicode, nullable=False)
     hash = Column(String, nullable=False)
+    # the identifier of the algorithm hash was computed with, see hasher.ALGORITHMS
+    algorithm = Column(String, nullable=False, default='md5')
     mtime = Column(DateTime, nullable=False)
     size = Column(BigInteger, nullable=False)
     host_id = Column(Integer, ForeignKey('host.id'), nullable=False)
@@ -352,15 +485,6 @@ class File(Base, FilesystemObject):
     folder_id = Column(Integer, ForeignKey('folder.id'), nullable=False)
     folder = relationship('Folder', backref=backref('files', lazy='subquery', cascade='all, delete'), lazy='subquery')
 
-    @property
-    def path(self):
-        """
-        @return: the path, honorees the local path separator
-        """
-        if self.folder is None:
-            return restore_utf8(self.name)
-        return '%s%s' % (self.folder.path, restore_utf8(self.name))
-
     @property
     def uri(self):
         """
@@ -371,6 +495,134 @@ class File(Base, FilesystemObject):
     def __repr__(self):
         return '<File(%s)>' % self.uri
 
+    @classmethod
+    def delete_by_ids(cls, obj_ids, session):
+        """
+        Deletes the files with the given ids, their additional Digests and their Blocks
+        @param obj_ids: ids of the files
+        @param session: The Session used for Querying
+        """
+        for offset in range(0, len(obj_ids), _IN_CHUNK):
+            chunk = obj_ids[offset:offset + _IN_CHUNK]
+            session.query(Digest).filter(Digest.file_id.in_(chunk)).delete(synchronize_session=False)
+            session.query(Block).filter(Block.file_id.in_(chunk)).delete(synchronize_session=False)
+            super().delete_by_ids(chunk, session)
+
+    @classmethod
+    def by_hashes(cls, hashes, host_id, session, algorithm='md5'):
+        """
+        Answers "which of these hashes already exist on the host" with one indexed query per chunk of hashes,
+        Files hashed with another algorithm are found by their additional Digests
+        @param hashes: iterable of hexdigested hashes
+        @param host_id: id of the host
+        @param session: The Session used for Querying
+        @param algorithm: the identifier of the algorithm the hashes were computed with
+        @return: dict hash -> (id, path) of one File with this hash on the host, missing hashes are left out
+        """
+        hashes = list(set(hashes))
+        result = dict()
+        for offset in range(0, len(hashes), _IN_CHUNK):
+            query = session.query(cls.hash, func.min(cls.id)).filter(
+                and_(cls.host_id == host_id, cls.algorithm == algorithm,
+                     cls.hash.in_(hashes[offset:offset + _IN_CHUNK]))).group_by(cls.hash)
+            result.update((fhash, file_id) for fhash, file_id in query)
+        missing = [fhash for fhash in hashes if fhash not in result]
+        for offset in range(0, len(missing), _IN_CHUNK):
+            query = session.query(Digest.hash, func.min(Digest.file_id)).join(cls, Digest.file_id == cls.id).filter(
+                and_(cls.host_id == host_id, Digest.algorithm == algorithm,
+                     Digest.hash.in_(missing[offset:offset + _IN_CHUNK]))).group_by(Digest.hash)
+            result.update((fhash, file_id) for fhash, file_id in query)
+        if result:
+            ids = list(result.values())
+            paths = dict()
+            for offset in range(0, len(ids), _IN_CHUNK):
+                paths.update(session.query(cls.id, cls.path).filter(cls.id.in_(ids[offset:offset + _IN_CHUNK])))
+            result = {fhash: (file_id, paths[file_id]) for fhash, file_id in result.items()}
+        return result
+
+
+class Digest(Base, DBObject):
+    """
+    An additional hash of a File, computed in the same read pass as File.hash, e.g. while migrating algorithms
+    """
+    __table_args__ = (
+        UniqueConstraint('file_id', 'algorithm'),
+        Index('ix_digest_algorithm_hash', 'algorithm', 'hash'),
+    )
+
+    algorithm = Column(String, nullable=False)
+    hash = Column(String, nullable=False)
+
+    file_id = Column(Integer, ForeignKey('file.id'), nullable=False)
+    file = relationship('File', backref=backref('digests', cascade='all, delete-orphan'))
+
+    def __repr__(self):
+        return '<Digest(file_id=%s, algorithm=%s)>' % (self.file_id, self.algorithm)
+
+    @classmethod
+    def by_files(cls, file_ids, session):
+        """
+        @param file_ids: ids of Files
+        @param session: The Session used for Querying
+        @return: dict file_id -> list of (algorithm, hash), files without Digests are left out
+        """
+        file_ids = list(set(file_ids))
+        result = dict()
+        for offset in range(0, len(file_ids), _IN_CHUNK):
+            query = session.query(cls.file_id, cls.algorithm, cls.hash).filter(
+                cls.file_id.in_(file_ids[offset:offset + _IN_CHUNK]))
+            for file_id, algorithm, digest in query:
+                result.setdefault(file_id, list()).append((algorithm, digest))
+        return result
+
+
+class Block(Base, DBObject):
+    """
+    The hash of a fixed size region of a File, computed with the algorithm of File.hash.
+    Only files larger than one block have Blocks.
+    """
+    __table_args__ = (
+        UniqueConstraint('file_id', 'offset'),
+    )
+
+    offset = Column(BigInteger, nullable=False)
+    size = Column(Integer, nullable=False)
+    algorithm = Column(String, nullable=False, default='md5')
+    hash = Column(String, nullable=False)
+
+    file_id = Column(Integer, ForeignKey('file.id'), nullable=False)
+    file = relationship('File', backref=backref('blocks', cascade='all, delete-orphan', order_by='Block.offset'))
+
+    def __repr__(self):
+        return '<Block(file_id=%s, offset=%s, size=%s)>' % (self.file_id, self.offset, self.size)
+
+    @classmethod
+    def by_files(cls, file_ids, session):
+        """
+        @param file_ids: ids of Files
+        @param session: The Session used for Querying
+        @return: dict file_id -> dict offset -> (size, algorithm, hash), files without Blocks are left out
+        """
+        file_ids = list(set(file_ids))
+        result = dict()
+        for offset in range(0, len(file_ids), _IN_CHUNK):
+            query = session.query(cls.file_id, cls.offset, cls.size, cls.algorithm, cls.hash).filter(
+                cls.file_id.in_(file_ids[offset:offset + _IN_CHUNK]))
+            for file_id, block_offset, size, algorithm, block_hash in query:
+                result.setdefault(file_id, dict())[block_offset] = (size, algorithm, block_hash)
+        return result
+
+    @staticmethod
+    def delta(source, target):
+        """
+        @param source: dict offset -> (size, algorithm, hash) of the source file, as returned by by_files
+        @param target: dict offset -> (size, algorithm, hash) of the target file
+        @return: sorted list of (offset, size) of the source blocks the target differs in,
+                 blocks hashed with different algorithms always differ
+        """
+        return [(offset, size) for offset, (size, algorithm, block_hash) in sorted(source.items())
+                if target.get(offset) != (size, algorithm, block_hash)]
+
 
 class Server(Base, DBObject):
     """
@@ -390,8 +642,13 @@ class HashRequest(Base, DBObject):
     """
     Represents a hash request, generate by a scanner, it will be fulfilled by a harsher and a server
     """
+    __table_args__ = (
+        Index('ix_hashrequest_host_path', 'host_id', 'path'),
+        Index('ix_hashrequest_locked', 'locked', 'locked_at'),
+    )
 
     name = Column(Unicode, nullable=False)
+    path = Column(Unicode, nullable=False)
     mtime = Column(DateTime, nullable=False)
     size = Column(BigInteger, nullable=False)
 
@@ -402,29 +659,208 @@ class HashRequest(Base, DBObject):
     folder = relationship('Folder')
 
     locked = Column(Boolean, default=False)
+    # when the lease of the hasher that locked the request started
+    locked_at = Column(DateTime)
 
     def __repr__(self):
         return '<HashRequest(id=%s, host_id=%s, locked=%s)>' % (self.id, self.host_id, self.locked)
 
-    @property
-    def path(self):
+    @classmethod
+    def claim(cls, host, limit, lease, session, own=False):
+        """
+        Atomically leases up to limit requests that are served by a Server or stored on host itself,
+        requests whose lease expired can be claimed again.
+        @param host: the Host of the hasher, it claims the requests of its region or, without region, its own
+        @param limit: the maximum number of requests
+        @param lease: seconds until a claimed request can be claimed by others again
+        @param session: The Session used for Querying, the caller has to commit
+        @param own: only claim the requests of host itself, whether they are served or not
+        @return: list of the ids of the claimed requests
+        """
+        now = datetime.now()
+        query = session.query(cls.id).join(cls.host)
+        if own:
+            query = query.filter(cls.host_id == host.id)
+        elif host.region_id is not None:
+            query = query.filter(Host.region_id == host.region_id)
+        else:
+            query = query.filter(cls.host_id == host.id)
+        # noinspection PyComparisonWithNone,PyPep8
+        query = query.filter(and_(or_(cls.locked == False, cls.locked_at < now - timedelta(seconds=lease)),
+                                  or_(cls.server != None, cls.host_id == host.id)))
+        ids = [row[0] for row in query.order_by(cls.id).limit(limit).with_for_update(skip_locked=True, of=cls)]
+        if ids:
+            session.query(cls).filter(cls.id.in_(ids)).update({cls.locked: True, cls.locked_at: now},
+                                                              synchronize_session=False)
+        logger.debug('Claimed %s HashRequests' % len(ids))
+        return ids
+
+    @classmethod
+    def delete_by_ids(cls, obj_ids, session):
         """
-        @return: the path, honorees the local path separator
+        Deletes the requests with the given ids and the Server entries announcing them
+        @param obj_ids: ids of the requests
+        @param session: The Session used for Querying
         """
-        return '%s%s' % (self.folder.path, restore_utf8(self.name))
+        obj_ids = list(obj_ids)
+        for offset in range(0, len(obj_ids), _IN_CHUNK):
+            chunk = obj_ids[offset:offset + _IN_CHUNK]
+            session.query(Server).filter(Server.request_id.in_(chunk)).delete(synchronize_session=False)
+            super().delete_by_ids(chunk, session)
 
 
-def _matching_chars(left, right):
-    index = 0
-    for char in left:
-        try:
-            if right[index] == char:
-                index += 1
-            else:
-                break
-        except IndexError:
-            break
-    return index
+CHILD_TYPES = {'file': File, 'folder': Folder, 'request': HashRequest}
+
+# Values per IN clause, even the three clauses of a children query stay below sqlite's limit of 999 parameters
+_IN_CHUNK = 300
+
+
+def _ids_in(session, column, key, values):
+    """
+    @param session: The Session used for Querying
+    @param column: the id column that is selected
+    @param key: the column that is filtered
+    @param values: the values key may have, they are queried in chunks of _IN_CHUNK
+    @return: list of the values of column in the rows whose key is one of values
+    """
+    return [row[0] for offset in range(0, len(values), _IN_CHUNK)
+            for row in session.query(column).filter(key.in_(values[offset:offset + _IN_CHUNK]))]
+
+
+# noinspection PyUnusedLocal
+@event.listens_for(Folder, 'before_insert')
+@event.listens_for(File, 'before_insert')
+@event.listens_for(HashRequest, 'before_insert')
+def _set_path(mapper, connection, target):
+    """
+    Materializes the path of new Folders, Files and HashRequests from the path of their parent
+    """
+    if target.path is not None:
+        return
+    if isinstance(target, Folder):
+        parent, parent_id, suffix = target.parent, target.parent_id, os.sep
+    else:
+        parent, parent_id, suffix = target.folder, target.folder_id, ''
+    if parent is None and parent_id is None:
+        target.path = target.name
+        return
+    if parent is not None:
+        parent_path = parent.path
+    else:
+        parent_path = connection.scalar(select([Folder.path]).where(Folder.id == parent_id))
+    target.path = '%s%s%s' % (parent_path, restore_utf8(target.name), suffix)
+
+
+class PathIndex(object):
+    """
+    A bounded, thread safe LRU cache mapping (host_id, path) to folder ids,
+    it is filled lazily by Host.descendant_by_path
+    @param maxsize: the maximum number of cached folders
+    """
+
+    def __init__(self, maxsize=2 ** 16):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, host_id, path):
+        """
+        @param host_id: id of the host the path belongs to
+        @param path: the path of the folder, with or without trailing separator
+        @return: the id of the folder or None if it is not cached
+        """
+        key = (host_id, path.rstrip(os.sep))
+        with self._lock:
+            folder_id = self._entries.get(key)
+            if folder_id is not None:
+                self._entries.move_to_end(key)
+        return folder_id
+
+    def put(self, host_id, path, folder_id):
+        """
+        @param host_id: id of the host the path belongs to
+        @param path: the path of the folder, with or without trailing separator
+        @param folder_id: the id of the folder
+        """
+        key = (host_id, path.rstrip(os.sep))
+        with self._lock:
+            self._entries[key] = folder_id
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate_path(self, host_id, path):
+        """
+        Removes the entry for path and all entries below it
+        @param host_id: id of the host the path belongs to
+        @param path: the path of a moved or deleted folder
+        """
+        path = path.rstrip(os.sep)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == host_id and
+                        (key[1] == path or key[1].startswith(path + os.sep))]:
+                del self._entries[key]
+
+    def invalidate_ids(self, folder_ids):
+        """
+        Removes all entries pointing to one of the given folders
+        @param folder_ids: ids of deleted folders
+        """
+        folder_ids = set(folder_ids)
+        with self._lock:
+            for key in [key for key, value in self._entries.items() if value in folder_ids]:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Empties the index
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+PATH_INDEX = PathIndex()
+
+# Objects with a forget_folders(folder_ids) method that is called by Folder.delete_by_ids with the ids of all
+# deleted folders, like the RequestBuffers of the scanner, which drop the requests of those folders
+FOLDER_OBSERVERS = weakref.WeakSet()
+
+# Key in Session.info of the ids of the Folders inserted by the running transaction
+_NEW_FOLDERS = 'new_folder_ids'
+
+
+# noinspection PyUnusedLocal
+@event.listens_for(Session, 'after_flush')
+def _remember_new_folders(session, flush_context):
+    """
+    Remembers the Folders inserted by the transaction, PATH_INDEX may only keep them if it commits
+    """
+    folder_ids = [obj.id for obj in session.new if isinstance(obj, Folder)]
+    if folder_ids:
+        session.info.setdefault(_NEW_FOLDERS, set()).update(folder_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _keep_new_folders(session):
+    """
+    The inserted Folders are committed, their PATH_INDEX entries stay valid
+    """
+    session.info.pop(_NEW_FOLDERS, None)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _evict_new_folders(session, transaction):
+    """
+    Removes the PATH_INDEX entries of Folders whose insert was rolled back or never committed,
+    their ids don't exist and may be reused by other Folders
+    """
+    if transaction.parent is None:
+        folder_ids = session.info.pop(_NEW_FOLDERS, None)
+        if folder_ids:
+            PATH_INDEX.invalidate_ids(folder_ids)
 
 
 def fix_encoding(string, method='xmlcharrefreplace'):
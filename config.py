@@ -2,11 +2,20 @@
 """
 This module contains the static methods for parsing the XML Configfile
 """
+from collections import namedtuple
 from functools import partial
+import os
+import socket
+from xml.etree import ElementTree
 
-from base import Folder
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import NoResultFound
+
+from base import Host, Region, fix_encoding
+import hasher
 import scanner
-import database
+import server
 
 
 __author__ = 'konsti'
@@ -17,28 +26,133 @@ logger = logging.getLogger(__name__)
 
 HOSTNAME = 'konsti-desktop'
 
+# The scan interval of scanners without interval attribute and the interval the hasher checks for requests
+SCANNER_INTERVAL = 300
+HASHER_INTERVAL = 30
+
+# The content of a configfile, see configfile.xsd,
+# scanners is a list of ScannerConfig and servers a list of the paths of the served folders
+HostConfig = namedtuple('HostConfig', ['hostname', 'region', 'database', 'hasher_processes', 'remote_digest',
+                                       'block_size', 'scanners', 'servers'])
+ScannerConfig = namedtuple('ScannerConfig', ['path', 'interval', 'watch', 'workers'])
+
+# A process started and supervised by main, target is called in the new process
+Role = namedtuple('Role', ['name', 'target'])
 
-def get_roles(configfile):
+
+def parse(configfile):
     """
     @param configfile: The Path of the xml configfile
-    @return a callable that creates the described role
+    @return: the HostConfig
+    @raise ValueError: if the file does not describe a Host
     """
-    #TODO: Dummy Implementation
+    root = ElementTree.parse(configfile).getroot()
+    if root.tag != 'Host':
+        raise ValueError('%s does not describe a Host' % configfile)
+    hasher_element = root.find('hasher')
+    processes = None if hasher_element is None else int(hasher_element.get('processes', os.cpu_count() or 1))
+    remote_digest = hasher_element is not None and _boolean(hasher_element, 'remote_digest')
+    block_size = None if hasher_element is None else _integer(hasher_element, 'block_size')
+    scanners = [ScannerConfig(path=_folder_path(element), interval=int(element.get('interval', SCANNER_INTERVAL)),
+                              watch=_boolean(element, 'watch'), workers=_integer(element, 'workers'))
+                for element in root.findall('scanner')]
+    servers = [_folder_path(element) for element in root.findall('server')]
+    return HostConfig(hostname=root.get('hostname', socket.gethostname()), region=root.get('region'),
+                      database=root.get('database'), hasher_processes=processes, remote_digest=remote_digest,
+                      block_size=block_size, scanners=scanners, servers=servers)
 
-    roles = list()
-    #roles.append(partial(hasher.run, 3, 120))
 
-    session = database.get_global_session()
+def _boolean(element, name):
+    """
+    @param element: an element of the configfile
+    @param name: the name of an xs:boolean attribute
+    @return: the value of the attribute, False if it is missing
+    """
+    return element.get(name, 'false') in ('true', '1')
 
-    #host = Host.by_name('konsti-desktop', database.get_global_session())
-    #folder = host.add_root('/media/konsti/Storage/makeMKV', database.get_global_session())
-    #folder = host.add_root('/home/konsti/Code', database.get_global_session())
-    folder = Folder.by_uri('konsti-desktop::/home/konsti/Code', session)
-    #session.add(host)
-    #session.add(folder)
-    #session.commit()
-    roles.append(partial(scanner.run, folder, 300))
 
-    print(roles)
+def _integer(element, name):
+    """
+    @param element: an element of the configfile
+    @param name: the name of an integer attribute
+    @return: the value of the attribute, None if it is missing
+    """
+    value = element.get(name)
+    return None if value is None else int(value)
 
-    return roles
\ No newline at end of file
+
+def _folder_path(element):
+    """
+    @param element: a scanner or server element
+    @return: the path of its folder on this host, the local path if it differs from the global one
+    @raise ValueError: if it has no folder
+    """
+    folder = element.find('folder')
+    path = None if folder is None else folder.get('local', folder.get('global'))
+    if not path:
+        raise ValueError('The %s element has no folder' % element.tag)
+    return path
+
+
+def get_roles(host_config):
+    """
+    @param host_config: the parsed configfile
+    @return a list of Roles, one hasher using hasher_processes processes, one scanner per root and one server
+    """
+    roles = list()
+    if host_config.hasher_processes:
+        roles.append(Role('hasher', partial(hasher.run, host_config.hasher_processes, HASHER_INTERVAL,
+                                            remote_digest=host_config.remote_digest, hostname=host_config.hostname,
+                                            block_size=host_config.block_size)))
+    for scanner_config in host_config.scanners:
+        roles.append(Role('scanner:%s' % scanner_config.path,
+                          partial(scanner.run, scanner_config.path, scanner_config.interval,
+                                  watch=scanner_config.watch, workers=scanner_config.workers)))
+    if host_config.servers:
+        # the server serves the requests of all roots of the host, the digests it sends carry the same blocks
+        args = ['--database', host_config.database, '--name', host_config.hostname]
+        if host_config.block_size is not None:
+            args += ['--block-size', str(host_config.block_size)]
+        roles.append(Role('server', partial(server.main, args)))
+    return roles
+
+
+def register_roots(host_config, database):
+    """
+    Creates the Host, its Region and the roots of the configured folders if they don't exist yet
+    @param host_config: the parsed configfile
+    @param database: the connection string
+    """
+    engine = create_engine(database, echo=False)
+    session = sessionmaker(bind=engine)()
+    try:
+        region = None
+        if host_config.region is not None:
+            try:
+                region = Region.by_name(host_config.region.lower(), session)
+            except NoResultFound:
+                region = Region.create_new(host_config.region.lower())
+                session.add(region)
+        try:
+            host = Host.by_name(host_config.hostname, session)
+        except NoResultFound:
+            logger.info('Host not found, creating new One')
+            host = Host.create_new(host_config.hostname, region)
+            session.add(host)
+        host.region = region
+        session.flush()
+        paths = [scanner_config.path for scanner_config in host_config.scanners] + host_config.servers
+        for path in paths:
+            try:
+                host.descendant_by_path(fix_encoding(path), session)
+            except NoResultFound:
+                logger.info('Adding root: %s' % path)
+                session.add(host.add_root(fix_encoding(path), session))
+                session.flush()
+        session.commit()
+    except Exception as error:
+        session.rollback()
+        raise error
+    finally:
+        session.close()
+        engine.dispose()
@@ -5,6 +5,8 @@ Contains Global Database settings and convenience functions
 import threading
 
 import sqlalchemy
+import sqlalchemy.orm
+import sqlalchemy.pool
 
 
 __author__ = 'konsti'
@@ -15,12 +17,73 @@ logger = logging.getLogger(__name__)
 
 DATABASE_STRING = None
 
+# Connection pool settings, they don't apply to sqlite which uses a pool of its own.
+# Every thread of a process that holds a connection at the same time as the others needs one of the pool,
+# the scanner workers hold one for a whole listing, see devices.scan_workers, the hasher one per thread.
+# They reserve their connections and the pool is made large enough, POOL_SIZE is its minimum size.
+POOL_SIZE = 20
+MAX_OVERFLOW = 10
+# Seconds after which a connection is replaced, keeps the server from closing idle ones behind our back
+POOL_RECYCLE = 3600
+# Tests each connection on checkout and transparently replaces dead ones
+POOL_PRE_PING = True
+
 _DATABASE = None
 
+# The number of threads of this process that use a connection at the same time, see reserve
+_RESERVED = 0
+
+_SESSION_MAKER = None
+_THREAD_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
 GLOBAL_SESSION = None
 GLOBAL_SESSION_LOCK = threading.Lock()
 
 
+def create_engine(database_string=None):
+    """
+    @param database_string: the connection string, defaults to DATABASE_STRING
+    @return: a new Engine using the configured pool settings
+    @raise RuntimeError: If DATABASE_STRING is not set or invalid
+    """
+    url = sqlalchemy.engine.url.make_url(database_string or DATABASE_STRING)
+    options = dict(echo=False, pool_pre_ping=POOL_PRE_PING)
+    if url.get_backend_name() != 'sqlite':
+        options.update(pool_size=pool_size(), max_overflow=MAX_OVERFLOW, pool_recycle=POOL_RECYCLE)
+    return sqlalchemy.create_engine(url, **options)
+
+
+def pool_size():
+    """
+    @return: the size of the pool of a new engine, large enough for the reserved connections
+    """
+    return max(POOL_SIZE, _RESERVED)
+
+
+def reserve(connections):
+    """
+    Called before starting threads that use a connection at the same time as the others.
+    A pool created afterwards is sized for them, the pool of an existing engine can't grow,
+    fewer threads are granted then, so none of them waits for a connection.
+    @param connections: the number of threads
+    @return: the number of threads that should be started, at least 1
+    """
+    global _RESERVED
+    with _SESSION_LOCK:
+        pool = None if _DATABASE is None else _DATABASE.pool
+        # noinspection PyProtectedMember
+        if isinstance(pool, sqlalchemy.pool.QueuePool) and pool._max_overflow >= 0:
+            # noinspection PyProtectedMember
+            free = pool.size() + pool._max_overflow - _RESERVED
+            if free < connections:
+                logger.warning('The pool has %s free connections, starting %s instead of %s threads'
+                               % (max(free, 0), max(free, 1), connections))
+                connections = max(free, 1)
+        _RESERVED += connections
+    return connections
+
+
 def get_database():
     """
     @return A Instance of the database defined in DATABASE_STRING
@@ -30,10 +93,25 @@ def get_database():
     global _DATABASE
 
     if _DATABASE is None:
-        _DATABASE = sqlalchemy.create_engine(DATABASE_STRING, echo=False, pool_size=100)
+        _DATABASE = create_engine()
     return _DATABASE
 
 
+def _get_session_makers():
+    """
+    @return: the sessionmaker and the scoped_session bound to the current database,
+             they are replaced if _DATABASE was replaced
+    """
+    global _SESSION_MAKER
+    global _THREAD_SESSION
+    engine = get_database()
+    with _SESSION_LOCK:
+        if _SESSION_MAKER is None or _SESSION_MAKER.kw['bind'] is not engine:
+            _SESSION_MAKER = sqlalchemy.orm.sessionmaker(bind=engine)
+            _THREAD_SESSION = sqlalchemy.orm.scoped_session(_SESSION_MAKER)
+        return _SESSION_MAKER, _THREAD_SESSION
+
+
 def get_session(new_engine=False):
     """
     @param new_engine: If true a new Engine is created from DATABASE_STRING
@@ -41,13 +119,46 @@ def get_session(new_engine=False):
     @raise RuntimeError: If DATABASE_STRING is not set or invalid
     """
     if new_engine:
-        engine = sqlalchemy.create_engine(DATABASE_STRING, echo=False, pool_size=100)
-        session_maker = sqlalchemy.orm.sessionmaker(bind=engine)
-    else:
-        session_maker = sqlalchemy.orm.sessionmaker(bind=get_database())
+        return sqlalchemy.orm.sessionmaker(bind=create_engine())()
+    session_maker, _ = _get_session_makers()
     return session_maker()
 
 
+def get_thread_session():
+    """
+    Closing the session returns its connection to the pool, the thread keeps using the same session object.
+    @return: the Session of the current thread
+    @raise RuntimeError: If DATABASE_STRING is not set or invalid
+    """
+    _, thread_session = _get_session_makers()
+    return thread_session()
+
+
+def dispose():
+    """
+    Drops the engine and its pooled connections, call it before forking, connections must not be shared
+    between processes
+    """
+    global _DATABASE
+    global _SESSION_MAKER
+    global _THREAD_SESSION
+    global _RESERVED
+    global GLOBAL_SESSION
+    with _SESSION_LOCK:
+        if _THREAD_SESSION is not None:
+            _THREAD_SESSION.remove()
+        _SESSION_MAKER = None
+        _THREAD_SESSION = None
+        _RESERVED = 0
+    with GLOBAL_SESSION_LOCK:
+        if GLOBAL_SESSION is not None:
+            GLOBAL_SESSION.close()
+        GLOBAL_SESSION = None
+    if _DATABASE is not None:
+        _DATABASE.dispose()
+    _DATABASE = None
+
+
 def get_global_session():
     """
     @return: A globally shared Session
@@ -55,8 +55,7 @@ def configure_logger():
     logging.info('Logging Started!')
 
 
-@asyncio.coroutine
-def commit():
+async def commit():
     """
     Coroutine, commits the DBSession
     """
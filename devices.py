@@ -0,0 +1,95 @@
+# coding=utf-8
+"""
+Tells apart the storage behind a path, so the concurrency of scanner and hasher follows the devices
+instead of one global constant.
+"""
+import os
+import time
+
+
+__author__ = 'konsti'
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Scanner workers per device, spinning disks are thrashed by concurrent seeks,
+# network filesystems need many concurrent requests to hide their latency
+ROTATIONAL_WORKERS = 2
+SOLID_STATE_WORKERS = 16
+REMOTE_WORKERS = 32
+
+# A directory listing slower than this many seconds indicates network storage
+REMOTE_LATENCY = 0.002
+
+
+def rotational(st_dev):
+    """
+    @param st_dev: the device id from a stat result
+    @return: True for spinning disks, False for solid state, None if sysfs does not tell, e.g. for network storage
+    """
+    device = '/sys/dev/block/%s:%s' % (os.major(st_dev), os.minor(st_dev))
+    # partitions have no queue of their own, it belongs to their disk
+    for path in (os.path.join(device, 'queue', 'rotational'), os.path.join(device, '..', 'queue', 'rotational')):
+        try:
+            with open(path) as file:
+                return file.read().strip() == '1'
+        except OSError:
+            continue
+    return None
+
+
+def latency(path, samples=3):
+    """
+    Times the first listing of the directory and of some directories below it, only a first listing tells
+    the device apart, a second one of the same directory is answered from the dentry cache on any device
+    @param path: the path of a directory
+    @param samples: the number of directories listed
+    @return: the median of the seconds a listing took
+    @raise OSError: if path can not be listed
+    """
+    times = list()
+    directories = [path]
+    while directories and len(times) < samples:
+        directory = directories.pop(0)
+        start = time.perf_counter()
+        try:
+            with os.scandir(directory) as entries:
+                entries = list(entries)
+        except OSError:
+            if directory == path:
+                raise
+            continue
+        times.append(time.perf_counter() - start)
+        # is_dir uses the type of the entry, it does not stat on most filesystems
+        directories += [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)][:samples]
+    return sorted(times)[len(times) // 2]
+
+
+def scan_workers(path, st_dev):
+    """
+    @param path: the path of a directory on the device
+    @param st_dev: the device id from a stat result
+    @return: the number of scanner workers for the device
+    """
+    is_rotational = rotational(st_dev)
+    if is_rotational is None:
+        try:
+            is_remote = latency(path) > REMOTE_LATENCY
+        except OSError as e:
+            logger.warning('Can not measure the latency of %s: %s' % (path, e))
+            is_remote = False
+        workers = REMOTE_WORKERS if is_remote else SOLID_STATE_WORKERS
+    else:
+        workers = ROTATIONAL_WORKERS if is_rotational else SOLID_STATE_WORKERS
+    logger.info('Using %s workers for device %s of %s' % (workers, st_dev, path))
+    return workers
+
+
+def hash_limit(st_dev, default):
+    """
+    @param st_dev: the device id from a stat result
+    @param default: the limit for devices that are not rotational
+    @return: the number of files on the device that are hashed at once, 1 for spinning disks
+    """
+    return 1 if rotational(st_dev) else default
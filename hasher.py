@@ -7,26 +7,209 @@ looks in the database if there is something to do,
 from _md5 import md5
 import argparse
 import asyncio
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
 import logging
+import os
 import socket
 import sys
 
-from sqlalchemy import and_, func
-
+import base
 import database
-from base import HashRequest, File, fix_encoding, Host, Region
+import devices
+from base import HashRequest, File, Digest, Block, fix_encoding, Host
+import protocol
 
 
 __author__ = 'konsti'
 logger = logging.getLogger(__name__)
 
+# Number of requests claimed at once and the seconds until they can be claimed by others again
+BATCH_SIZE = 16
+LEASE = 3600
+
+# Size of the reads used to hash local files
+READ_BUFFER = 2 ** 20
+
+# Let the servers hash the files and only transfer the digests
+REMOTE_DIGEST = False
+
+# The hash constructors by algorithm identifier, the identifier is stored with every hash
+ALGORITHMS = OrderedDict([('md5', md5), ('blake2b', hashlib.blake2b), ('sha1', hashlib.sha1)])
+try:
+    import xxhash
+    ALGORITHMS['xxh64'] = xxhash.xxh64
+except ImportError:
+    xxhash = None
+
+# The algorithms computed for new files in a single read pass, the first one is stored as File.hash,
+# the others as Digests, e.g. ('blake2b', 'md5') while migrating from md5 to blake2b
+HASH_ALGORITHMS = ('md5', )
+
+# The chunked digest that can be computed in parallel, its leaves and the ranges of leaves hashed by one process
+TREE_ALGORITHM = 'blake2b-tree'
+TREE_LEAF_SIZE = 2 ** 22
+
+# Size of the blocks whose hashes are stored for files larger than one block, sync compares them to send only
+# the changed blocks of a file (DELTA). They cost a second pass of the primary algorithm over the data,
+# 0 disables them, files hashed with TREE_ALGORITHM get the blocks of their leaves for free.
+BLOCK_SIZE = TREE_LEAF_SIZE
+PARALLEL_RANGE = 16 * TREE_LEAF_SIZE
+
+# Files at least this large are hashed in parallel ranges, if TREE_ALGORITHM is the only algorithm
+PARALLEL_SIZE = 2 ** 28
+
+
+class TreeHash(object):
+    """
+    A chunked digest: the blake2b of the blake2b digests of the TREE_LEAF_SIZE leaves of the data,
+    the leaves are independent of each other, so the ranges of a file can be hashed in parallel
+    """
+
+    def __init__(self):
+        self._root = hashlib.blake2b()
+        self._leaf = hashlib.blake2b()
+        self._length = 0
+        self._leaves = list()
+
+    def update(self, data):
+        """
+        @param data: bytes like object
+        """
+        view = memoryview(data)
+        while len(view):
+            part = view[:TREE_LEAF_SIZE - self._length]
+            self._leaf.update(part)
+            self._length += len(part)
+            view = view[len(part):]
+            if self._length == TREE_LEAF_SIZE:
+                digest = self._leaf.digest()
+                self._root.update(digest)
+                self._leaves.append(digest)
+                self._leaf = hashlib.blake2b()
+                self._length = 0
+
+    def hexdigest(self):
+        """
+        @return: the hexdigest of the data hashed so far, the last leaf may be shorter
+        """
+        root = self._root.copy()
+        if self._length:
+            root.update(self._leaf.digest())
+        return root.hexdigest()
+
+    def blocks(self):
+        """
+        @return: list of (offset, size, hexdigest) of the leaves hashed so far, the same blocks as
+                 calculate_parallel_hash, without hashing the data again
+        """
+        leaves = [(TREE_LEAF_SIZE, digest) for digest in self._leaves]
+        if self._length:
+            leaves.append((self._length, self._leaf.digest()))
+        return _leaf_blocks(leaves)
+
+    @classmethod
+    def from_leaves(cls, leaves):
+        """
+        @param leaves: the digests of the leaves in order, as returned by hash_leaves
+        @return: a TreeHash of the data the leaves were computed of
+        """
+        tree = cls()
+        for leaf in leaves:
+            tree._root.update(leaf)
+        return tree
+
+
+ALGORITHMS[TREE_ALGORITHM] = TreeHash
+
+
+def _leaf_blocks(leaves):
+    """
+    @param leaves: list of (size, digest) of consecutive leaves
+    @return: list of (offset, size, hexdigest) of the blocks, the hexdigest of a block is the TreeHash of its leaf
+    """
+    blocks = list()
+    offset = 0
+    for size, digest in leaves:
+        blocks.append((offset, size, TreeHash.from_leaves([digest]).hexdigest()))
+        offset += size
+    return blocks
+
+
+class Hashes(OrderedDict):
+    """
+    OrderedDict algorithm -> hexdigest, the first one is the primary hash
+    @ivar blocks: list of (offset, size, hexdigest) of the fixed size blocks, hashed with the primary algorithm
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.blocks = list()
+
+
+class MultiHash(object):
+    """
+    Feeds the data to several hash algorithms at once, so a file has to be read only once,
+    the data is hashed in blocks of block_size with the primary algorithm as well,
+    unless the primary algorithm is TREE_ALGORITHM, its leaves are the blocks then
+    @param algorithms: the algorithm identifiers, defaults to HASH_ALGORITHMS
+    @param block_size: the size of the blocks, defaults to BLOCK_SIZE, 0 for no blocks
+    """
+
+    def __init__(self, algorithms=None, block_size=None):
+        algorithms = algorithms or HASH_ALGORITHMS
+        block_size = BLOCK_SIZE if block_size is None else block_size
+        self._hashes = OrderedDict((algorithm, ALGORITHMS[algorithm]()) for algorithm in algorithms)
+        primary = self._hashes[algorithms[0]]
+        self._tree = primary if isinstance(primary, TreeHash) else None
+        self._block_size = None if self._tree is not None else block_size or None
+        self._block_algorithm = ALGORITHMS[algorithms[0]]
+        self._block = self._block_algorithm()
+        self._block_offset = 0
+        self._block_length = 0
+        self._blocks = list()
+
+    def update(self, data):
+        """
+        @param data: bytes like object
+        """
+        for _hash in self._hashes.values():
+            _hash.update(data)
+        if self._block_size is None:
+            return
+        view = memoryview(data)
+        while len(view):
+            part = view[:self._block_size - self._block_length]
+            self._block.update(part)
+            self._block_length += len(part)
+            view = view[len(part):]
+            if self._block_length == self._block_size:
+                self._finish_block()
+
+    def _finish_block(self):
+        self._blocks.append((self._block_offset, self._block_length, self._block.hexdigest()))
+        self._block_offset += self._block_length
+        self._block_length = 0
+        self._block = self._block_algorithm()
+
+    def hexdigests(self):
+        """
+        @return: Hashes of the data hashed so far
+        """
+        if self._block_length:
+            self._finish_block()
+        digests = Hashes((algorithm, _hash.hexdigest()) for algorithm, _hash in self._hashes.items())
+        digests.blocks = self._tree.blocks() if self._tree is not None else list(self._blocks)
+        return digests
+
 
 def calculate_hash(ip, port, server_id):
     """
     @param ip: The Server IP
     @param port: The Port the File is served on
     @param server_id: The database server_id
-    @return: the hash
+    @return: Hashes, see MultiHash
     """
     logger.info('Calculating hash for: %s ' % server_id)
 
@@ -36,7 +219,7 @@ def calculate_hash(ip, port, server_id):
     sock.send(bytes('%s\n' % server_id, encoding='ascii'))
     sock.settimeout(5000)
     try:
-        _hash = md5()
+        _hash = MultiHash()
         while True:
             data = sock.recv(2 ** 14)
             _hash.update(data)
@@ -45,83 +228,385 @@ def calculate_hash(ip, port, server_id):
 
     finally:
         sock.close()
-    return _hash.hexdigest()
+    return _hash.hexdigests()
 
 
-def get_request():
+def calculate_local_hash(path, algorithms=None, block_size=None):
     """
-    @return: a random request guarantied to be locked and unique
+    Hashes a file on this host directly, without a Server in between, see calculate_parallel_hash for large files
+    @param path: the path of the file
+    @param algorithms: the algorithm identifiers, defaults to HASH_ALGORITHMS
+    @param block_size: the size of the blocks, defaults to BLOCK_SIZE, 0 for no blocks
+    @return: Hashes, see MultiHash
     """
-    session = database.get_session()
-    me = Host.by_name(socket.gethostname(), session)
-    if me.region is not None:
-        # noinspection PyComparisonWithNone,PyPep8
-        query = session.query(HashRequest).join(HashRequest.host).join(Host.region).filter(
-            and_(HashRequest.locked == False, HashRequest.server != None,
-                 Region.id == me.region.id)).order_by(func.random()).with_for_update()
-    else:
-        # noinspection PyComparisonWithNone,PyPep8
-        query = session.query(HashRequest).join(HashRequest.host).filter(
-            and_(HashRequest.locked == False, HashRequest.server != None,
-                 HashRequest.host == me)).order_by(func.random()).with_for_update()
+    logger.info('Calculating local hash for: %s ' % path)
+    _hash = MultiHash(algorithms, block_size)
+    buffer = bytearray(READ_BUFFER)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            length = file.readinto(buffer)
+            if not length:
+                break
+            _hash.update(view[:length])
+    return _hash.hexdigests()
+
+
+def is_parallel(size, algorithms=None):
+    """
+    @param size: the size of a file in byte
+    @param algorithms: the algorithm identifiers, defaults to HASH_ALGORITHMS
+    @return: True if the file should be hashed with calculate_parallel_hash
+    """
+    return size >= PARALLEL_SIZE and tuple(algorithms or HASH_ALGORITHMS) == (TREE_ALGORITHM, )
+
+
+def calculate_parallel_hash(path, pool):
+    """
+    Hashes a local file with TREE_ALGORITHM, its ranges are hashed concurrently in pool
+    @param path: the path of the file
+    @param pool: the Executor the ranges are hashed in, usually a ProcessPoolExecutor
+    @return: Hashes, see MultiHash, with the leaves as blocks
+    """
+    logger.info('Calculating parallel hash for: %s ' % path)
+    size = os.path.getsize(path)
+    futures = [pool.submit(hash_leaves, path, offset, min(PARALLEL_RANGE, size - offset))
+               for offset in range(0, size, PARALLEL_RANGE)]
+    leaves = [leaf for future in futures for leaf in future.result()]
+    hashes = Hashes([(TREE_ALGORITHM, TreeHash.from_leaves(digest for _, digest in leaves).hexdigest())])
+    hashes.blocks = _leaf_blocks(leaves)
+    return hashes
+
+
+def hash_leaves(path, offset, length):
+    """
+    Hashes the TREE_LEAF_SIZE leaves of a range of a file, this runs in the worker processes
+    @param path: the path of the file
+    @param offset: the position of the range, a multiple of TREE_LEAF_SIZE
+    @param length: the length of the range
+    @return: list of (length, digest) of the leaves
+    """
+    leaves = list()
+    view = memoryview(bytearray(TREE_LEAF_SIZE))
+    with open(path, 'rb', buffering=0) as file:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file.fileno(), offset, length, os.POSIX_FADV_SEQUENTIAL)
+        file.seek(offset)
+        while length > 0:
+            size = 0
+            leaf_size = min(TREE_LEAF_SIZE, length)
+            while size < leaf_size:
+                read = file.readinto(view[size:leaf_size])
+                if not read:
+                    break
+                size += read
+            if not size:
+                break
+            leaves.append((size, hashlib.blake2b(view[:size]).digest()))
+            length -= size
+    return leaves
+
+
+async def calculate_hashes_async(ip, port, server_ids, executor=None, digest=False, block_size=None):
+    """
+    Requests many files over a single pipelined connection, see protocol,
+    received data is digested in executor while the next frame is read
+    @param ip: The Server IP
+    @param port: The Port the Files are served on
+    @param server_ids: The database server_ids
+    @param executor: the Executor the data is digested in, None for the default one of the loop
+    @param digest: let the server hash the files, so only the digests cross the network,
+                   the server uses its own algorithms and block size then
+    @param block_size: the size of the blocks, defaults to BLOCK_SIZE, 0 for no blocks
+    @return: dict server_id -> Hashes, None for the files the server failed to send
+    """
+    logger.info('Calculating hashes for: %s ' % list(server_ids))
+    loop = asyncio.get_event_loop()
+    hashes = {server_id: MultiHash(block_size=block_size) for server_id in server_ids}
+    digests = {server_id: bytes() for server_id in server_ids}
+    result = dict()
+    pending = None
+    reader, writer = await asyncio.open_connection(ip, port)
+    try:
+        writer.write(protocol.MAGIC + protocol.pack_requests(hashes, digest))
+        while len(result) < len(hashes):
+            server_id, length = protocol.DATA.unpack(await reader.readexactly(protocol.DATA.size))
+            if length == protocol.ERROR:
+                result[server_id] = None
+            elif length == 0:
+                if pending is not None:
+                    await pending
+                    pending = None
+                result[server_id] = _parse_digests(digests[server_id]) if digest else hashes[server_id].hexdigests()
+            elif digest:
+                digests[server_id] += await reader.readexactly(length)
+            else:
+                data = await reader.readexactly(length)
+                # the updates of a hash have to stay in order, so only one is pending at a time
+                if pending is not None:
+                    await pending
+                pending = loop.run_in_executor(executor, hashes[server_id].update, data)
+    finally:
+        writer.close()
+    return result
+
+
+def _parse_digests(data):
+    """
+    @param data: the answer of a server to a DIGEST request
+    @return: Hashes, with the blocks the server computed
+    """
+    digests, blocks = protocol.parse_digests(data)
+    hashes = Hashes(digests)
+    hashes.blocks = blocks
+    return hashes
+
+
+def get_requests(batch=BATCH_SIZE, lease=LEASE, hostname=None):
+    """
+    @param batch: the number of requests claimed at once
+    @param lease: seconds until the claimed requests can be claimed by other hashers again
+    @param hostname: the name the hasher's host is registered under, defaults to base.LOCAL_HOSTNAME
+    @return: list of ids of requests guarantied to be leased by this process, empty if there is nothing to do
+    """
+    session = database.get_thread_session()
     try:
-        request = query.first()
-        if request is None:
-            return None
-        request.locked = True
+        me = Host.by_name(hostname or base.LOCAL_HOSTNAME, session)
+        request_ids = HashRequest.claim(me, batch, lease, session)
         session.commit()
-        return request
     except Exception as error:
         session.rollback()
         raise error
+    finally:
+        session.close()
+    return request_ids
 
+
+def load_requests(request_ids, hostname=None):
+    """
+    @param request_ids: ids of claimed requests
+    @param hostname: the name the hasher's host is registered under, defaults to base.LOCAL_HOSTNAME
+    @return: list of (id, path, size, is_local, (server_id, ip, port) or None) of the requests
+    """
+    hostname = hostname or base.LOCAL_HOSTNAME
+    session = database.get_thread_session()
+    try:
+        requests = session.query(HashRequest).filter(HashRequest.id.in_(request_ids)).all()
+        return [(request.id, request.path, request.size, request.host.name == hostname,
+                 None if request.server is None else (request.server.id, request.server.ip, request.server.port))
+                for request in requests]
     finally:
         session.close()
 
 
-def work(interval):
+def store_hashes(hashes):
     """
-    This is where the work is done
-    @param interval: The interval between two calls if there are no request
+    Replaces the hashed requests with Files in a single transaction, every request in a savepoint of its own,
+    so one that fails does not take the others down. A failed request whose File exists already is deleted,
+    the lease of the other failed ones is released, so they are hashed again.
+    @param hashes: dict request_id -> Hashes
     """
-    logger.debug('Worker Running!')
-    loop = asyncio.get_event_loop()
-    session = database.get_session()
-    request = get_request()
-    if request is None:
-        loop.call_later(interval, work, interval)
-        logger.debug('Waiting for Request, check again in %s seconds.' % interval)
-        return False
+    if not hashes:
+        return
+    session = database.get_thread_session()
     try:
-        logger.info('Calculating Hash for: %s' % request)
-        request = session.merge(request)
-        fhash = calculate_hash(request.server.ip, request.server.port, request.server.id)
-
-        file = File(name=fix_encoding(request.name), folder=request.folder, mtime=request.mtime,
-                    size=request.size,
-                    host=request.host, hash=fhash)
-        session.add(file)
-        session.delete(request.server)
-        session.delete(request)
+        failed = list()
+        for request in session.query(HashRequest).filter(HashRequest.id.in_(list(hashes))).all():
+            try:
+                with session.begin_nested():
+                    fulfill(request, hashes[request.id], session)
+            except Exception as e:
+                logger.error('Storing the hash of %s failed: %s' % (request.path, e))
+                failed.append(request)
+        for request in failed:
+            if session.query(File.id).filter(File.folder_id == request.folder_id,
+                                             File.name == fix_encoding(request.name)).first() is not None:
+                logger.info('%s was hashed already' % request.path)
+                if request.server is not None:
+                    session.delete(request.server)
+                session.delete(request)
+            else:
+                request.locked = False
+                request.locked_at = None
         session.commit()
-    except Exception as e:
-        logger.exception(e)
+    except Exception as error:
         session.rollback()
+        raise error
+    finally:
+        session.close()
+
+
+class Engine(object):
+    """
+    Runs number hashing jobs concurrently on one event loop, the connections to the Servers use asyncio streams,
+    the database queries and the digesting of received data run in a thread pool,
+    local files are hashed in a process pool.
+    @param number: the number of concurrent jobs and hashing processes
+    @param interval: the seconds a job waits if there is nothing to do
+    @param batch: the number of requests a job claims at once
+    @param lease: seconds until the claimed requests can be claimed by other hashers again
+    @param loop: the event loop, defaults to the current one
+    @param device_limit: the number of local files per device hashed at once,
+                         None for 1 on spinning disks and number on the others
+    @param remote_digest: let the servers hash the files and only transfer the digests, None for REMOTE_DIGEST
+    @param hostname: the name the hasher's host is registered under, defaults to base.LOCAL_HOSTNAME
+    @param block_size: the size of the blocks of the block index, None for BLOCK_SIZE, 0 for no blocks
+    """
+
+    def __init__(self, number, interval, batch=BATCH_SIZE, lease=LEASE, loop=None, device_limit=None,
+                 remote_digest=None, hostname=None, block_size=None):
+        self.number = number
+        self.interval = interval
+        self.batch = batch
+        self.lease = lease
+        self.loop = loop or asyncio.get_event_loop()
+        self.device_limit = device_limit
+        self.remote_digest = REMOTE_DIGEST if remote_digest is None else remote_digest
+        self.hostname = hostname or base.LOCAL_HOSTNAME
+        self.block_size = BLOCK_SIZE if block_size is None else block_size
+        self._devices = dict()
+        # a job waits for at most one thread at a time, the parallel hashes wait for the processes in one as well,
+        # every thread may hold a connection
+        self.threads = ThreadPoolExecutor(database.reserve(2 * number))
+        self.processes = ProcessPoolExecutor(number)
+
+    def run(self):
+        """
+        Runs the jobs, they never finish on their own
+        """
+        self.loop.run_until_complete(asyncio.gather(*(self.job() for _ in range(self.number))))
+
+    def close(self):
+        """
+        Shuts the pools down
+        """
+        self.threads.shutdown()
+        self.processes.shutdown()
+
+    async def job(self):
+        """
+        Hashes batches until there are no requests left, then checks again every interval seconds
+        """
+        while True:
+            try:
+                hashed = await self.work()
+            except Exception as e:
+                # The requests stay leased, they are retried when the lease expires
+                logger.exception(e)
+                hashed = False
+            if not hashed:
+                logger.debug('Waiting for Request, check again in %s seconds.' % self.interval)
+                await asyncio.sleep(self.interval)
 
-    loop.call_soon(work, interval)
-    return True
+    async def work(self):
+        """
+        This is where the work is done, the claimed batch is hashed locally or
+        with one pipelined connection per Server
+        @return: False if there was nothing to do
+        """
+        request_ids = await self.loop.run_in_executor(self.threads, get_requests, self.batch, self.lease,
+                                                      self.hostname)
+        if not request_ids:
+            return False
+        requests = await self.loop.run_in_executor(self.threads, load_requests, request_ids, self.hostname)
+        local = list()
+        served = defaultdict(list)
+        for request_id, path, size, is_local, server in requests:
+            logger.info('Calculating Hash for: %s' % path)
+            if is_local:
+                local.append((request_id, self.hash_local(path, size)))
+            elif server is not None:
+                server_id, ip, port = server
+                served[(ip, port)].append((request_id, server_id))
 
+        tasks = [task for _, task in local]
+        tasks += [calculate_hashes_async(ip, port, [server_id for _, server_id in group], self.threads,
+                                         self.remote_digest, self.block_size) for (ip, port), group in served.items()]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
 
-def run(number, interval):
+        hashes = dict()
+        for (request_id, _), result in zip(local, results):
+            if isinstance(result, Exception):
+                logger.error('Hashing failed: %s' % result)
+            else:
+                hashes[request_id] = result
+        for group, result in zip(served.values(), results[len(local):]):
+            if isinstance(result, Exception):
+                logger.error('Hashing failed: %s' % result)
+                continue
+            for request_id, server_id in group:
+                if result.get(server_id) is not None:
+                    hashes[request_id] = result[server_id]
+        await self.loop.run_in_executor(self.threads, store_hashes, hashes)
+        return True
 
+    async def hash_local(self, path, size):
+        """
+        Hashes a local file as soon as its device is not busy with device_limit other files
+        @param path: the path of a local file
+        @param size: the size of the file in byte
+        @return: the Hashes of the file
+        """
+        st_dev = (await self.loop.run_in_executor(self.threads, os.stat, path)).st_dev
+        semaphore = self._devices.get(st_dev)
+        if semaphore is None:
+            limit = self.device_limit or devices.hash_limit(st_dev, self.number)
+            semaphore = self._devices[st_dev] = asyncio.Semaphore(limit)
+        await semaphore.acquire()
+        try:
+            if is_parallel(size):
+                return await self.loop.run_in_executor(self.threads, calculate_parallel_hash, path, self.processes)
+            return await self.loop.run_in_executor(self.processes, calculate_local_hash, path, HASH_ALGORITHMS,
+                                                   self.block_size)
+        finally:
+            semaphore.release()
+
+
+def fulfill(request, digests, session):
     """
-    @param number: Number of Processes to spawn
+    Replaces the request with a File
+    @param request: the HashRequest
+    @param digests: Hashes of the file, the first one becomes File.hash, the blocks are stored if there are several,
+                    they are hashed with the same algorithm
+    @param session: The Session used for Querying
+    """
+    (algorithm, fhash), *others = digests.items()
+    file = File(name=fix_encoding(request.name), path=request.path, folder=request.folder, mtime=request.mtime,
+                size=request.size,
+                host=request.host, hash=fhash, algorithm=algorithm)
+    file.digests = [Digest(algorithm=other, hash=other_hash) for other, other_hash in others]
+    blocks = getattr(digests, 'blocks', ())
+    if len(blocks) > 1:
+        file.blocks = [Block(offset=offset, size=size, algorithm=algorithm, hash=block_hash)
+                       for offset, size, block_hash in blocks]
+    session.add(file)
+    if request.server is not None:
+        session.delete(request.server)
+    session.delete(request)
+
+
+def run(number, interval, batch=BATCH_SIZE, lease=LEASE, device_limit=None, remote_digest=None, hostname=None,
+        block_size=None):
+
+    """
+    @param number: Number of concurrent jobs and hashing processes
     @param interval: Time to wait between checking for new Requests
+    @param batch: the number of requests a job claims at once
+    @param lease: seconds until the claimed requests can be claimed by other hashers again
+    @param device_limit: the number of local files per device hashed at once, None to choose it per device
+    @param remote_digest: let the servers hash the files and only transfer the digests, None for REMOTE_DIGEST
+    @param hostname: the name the hasher's host is registered under, defaults to base.LOCAL_HOSTNAME
+    @param block_size: the size of the blocks of the block index, None for BLOCK_SIZE, 0 for no blocks
     """
     logger.debug('Hasher running with:(number:%s, interval:%s)' % (number, interval))
-    loop = asyncio.get_event_loop()
-    for _ in range(number):
-        loop.call_soon(work, interval)
+    engine = Engine(number, interval, batch, lease, device_limit=device_limit, remote_digest=remote_digest,
+                    hostname=hostname, block_size=block_size)
+    try:
+        engine.run()
+    finally:
+        engine.close()
 
 
 def main(args=sys.argv[1:]):
@@ -135,12 +620,35 @@ def main(args=sys.argv[1:]):
     parser.add_argument('-i', '--interval', type=int, metavar='SECONDS', default=30,
                         help='Interval between two Scan runs, defaults to 1 hour')
     parser.add_argument('-n', '--number', help='Number of processes used', type=int, metavar='NUMBER', default=1)
+    parser.add_argument('-b', '--batch', type=int, metavar='NUMBER', default=BATCH_SIZE,
+                        help='Number of requests a job claims at once')
+    parser.add_argument('--lease', type=int, metavar='SECONDS', default=LEASE,
+                        help='Seconds until claimed requests can be claimed by other hashers again')
+    parser.add_argument('--device-limit', type=int, metavar='NUMBER', default=None,
+                        help='Number of local files per device hashed at once, defaults to 1 for spinning disks')
+    parser.add_argument('-a', '--algorithm', action='append', choices=list(ALGORITHMS), dest='algorithms',
+                        help='Hash algorithm, repeat to compute several digests in one pass, the first is the primary')
+    parser.add_argument('--remote-digest', action='store_true',
+                        help='Let the servers hash the files and only transfer the digests')
+    parser.add_argument('--name', type=str, metavar='"HOSTNAME"', default=None,
+                        help='The name the host is registered under, defaults to the machine name')
+    parser.add_argument('--block-size', type=int, metavar='BYTES', default=None,
+                        help='Size of the blocks whose hashes are stored for delta syncs, 0 disables them, '
+                             'defaults to %s' % BLOCK_SIZE)
     args = parser.parse_args(args)
+    if args.algorithms:
+        global HASH_ALGORITHMS
+        HASH_ALGORITHMS = tuple(args.algorithms)
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
         logger.debug('Hasher started with following arguments: %s' % args)
     else:
         logging.basicConfig(level=logging.INFO)
 
+    database.DATABASE_STRING = args.database
+    run(args.number, args.interval, args.batch, args.lease, args.device_limit, args.remote_digest, args.name,
+        args.block_size)
+
+
 if __name__ == '__main__':
     exit(main())
@@ -7,6 +7,7 @@ import asyncio
 from multiprocessing.context import Process
 import sys
 
+import base
 import config
 import database
 import database_logging
@@ -19,17 +20,48 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def run(configfile):
+# Seconds between two checks whether the role processes are still alive
+SUPERVISE_INTERVAL = 10
+
+
+def run(host_config):
     """
-    This method is called after initializing the framework and starts the configured servers.
-    @param configfile: Path referring to the xml configfile.
+    This method is called after initializing the framework and starts the configured roles.
+    @param host_config: the parsed configfile, see config.parse
+    @return: a dict mapping the Roles to their started processes
     """
     logger.debug('run() method started!')
-    for role in config.get_roles(configfile):
-        process = Process(target=role)
-        print('Starting Process!')
-        process.start()
+    processes = dict()
+    for role in config.get_roles(host_config):
+        processes[role] = start(role)
     logger.debug('run() is done!')
+    return processes
+
+
+def start(role):
+    """
+    @param role: the Role that is started
+    @return: the Process running it
+    """
+    # not daemonic, the hasher and the server start processes of their own
+    database.dispose()
+    process = Process(target=role.target, name=role.name)
+    process.start()
+    logger.info('Started %s in process %s' % (role.name, process.pid))
+    return process
+
+
+def supervise(processes, loop):
+    """
+    Restarts the roles whose process died and reschedules itself
+    @param processes: a dict mapping the Roles to their processes, updated in place
+    @param loop: the event loop used for rescheduling
+    """
+    for role, process in list(processes.items()):
+        if not process.is_alive():
+            logger.warning('%s exited with %s, restarting it' % (role.name, process.exitcode))
+            processes[role] = start(role)
+    loop.call_later(SUPERVISE_INTERVAL, supervise, processes, loop)
 
 
 def main(args=sys.argv[1:]):
@@ -38,18 +70,38 @@ def main(args=sys.argv[1:]):
     @param args: the args used for the parser, just useful for testing
     """
     parser = argparse.ArgumentParser(description='Tool MainExecutable')
-    parser.add_argument('-d', '--database', type=str, metavar='"Connection String"', required=True)
+    parser.add_argument('-d', '--database', type=str, metavar='"Connection String"', default=None,
+                        help='Defaults to the database attribute of the config')
     parser.add_argument('-c', '--config', type=str, metavar='"Config Path"', default='configfile.xml')
+    parser.add_argument('--pool-size', type=int, metavar='NUMBER', default=database.POOL_SIZE,
+                        help='Number of connections each process keeps open to the database')
+    parser.add_argument('--max-overflow', type=int, metavar='NUMBER', default=database.MAX_OVERFLOW,
+                        help='Number of connections opened beyond the pool size under load')
+    parser.add_argument('--pool-recycle', type=int, metavar='SECONDS', default=database.POOL_RECYCLE,
+                        help='Seconds after which a pooled connection is replaced')
     parser.add_argument('--debug', action='store_true')
 
     args = parser.parse_args(args)
 
+    host_config = config.parse(args.config)
+    args.database = args.database or host_config.database
+    if args.database is None:
+        parser.error('the config has no database attribute, -d/--database is required')
+    host_config = host_config._replace(database=args.database)
+    # the roles look their host up by this name, not by the machine name
+    config.HOSTNAME = base.LOCAL_HOSTNAME = host_config.hostname
+
     database.DATABASE_STRING = args.database
+    database.POOL_SIZE = args.pool_size
+    database.MAX_OVERFLOW = args.max_overflow
+    database.POOL_RECYCLE = args.pool_recycle
+    config.register_roots(host_config, args.database)
     database_logging.start_logging_process()
     database_logging.configure_logger()
 
     loop = asyncio.get_event_loop()
-    loop.call_soon(run, args.config)
+    processes = run(host_config)
+    loop.call_later(SUPERVISE_INTERVAL, supervise, processes, loop)
     loop.run_forever()
 
     return 0
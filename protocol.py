@@ -0,0 +1,128 @@
+# coding=utf-8
+"""
+The framed protocol spoken between hasher and server, it allows a hasher to request many files over one connection.
+
+A connection starts with MAGIC, followed by any number of REQUEST frames (server_id, offset, length),
+length is -1 for "up to the end of the file", DIGEST asks the server to send the digests of the file
+(see format_digests) instead of its content and a server_id of 0 ends the requests.
+The server answers every request in order with DATA frames (server_id, length) followed by length bytes,
+a frame with length 0 ends a file, a frame with length ERROR tells the file could not be served.
+"""
+from collections import OrderedDict
+import struct
+
+
+__author__ = 'konsti'
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SYN1'
+REQUEST = struct.Struct('>QQq')
+DATA = struct.Struct('>QI')
+ERROR = 2 ** 32 - 1
+END = 0
+DIGEST = -2
+# The key of the block hashes in the answer to a DIGEST request
+BLOCK = 'block'
+
+
+def pack_requests(server_ids, digest=False):
+    """
+    @param server_ids: iterable of database server_ids
+    @param digest: request the digests of the files instead of their content
+    @return: the bytes requesting the whole files, including the terminating frame
+    """
+    frames = [REQUEST.pack(server_id, 0, DIGEST if digest else -1) for server_id in server_ids]
+    frames.append(REQUEST.pack(END, 0, -1))
+    return b''.join(frames)
+
+
+def format_digests(digests, blocks=()):
+    """
+    @param digests: OrderedDict algorithm -> hexdigest
+    @param blocks: list of (offset, size, hexdigest) of the blocks of the file
+    @return: the bytes sent as answer to a DIGEST request, the blocks follow the digests as BLOCK:offset:size:hexdigest
+    """
+    items = ['%s:%s' % item for item in digests.items()]
+    items += ['%s:%s:%s:%s' % (BLOCK, offset, size, block_hash) for offset, size, block_hash in blocks]
+    return ' '.join(items).encode('ascii')
+
+
+def parse_digests(data):
+    """
+    @param data: the bytes sent as answer to a DIGEST request
+    @return: (OrderedDict algorithm -> hexdigest, list of (offset, size, hexdigest) of the blocks)
+    """
+    digests = OrderedDict()
+    blocks = list()
+    for item in data.decode('ascii').split():
+        key, value = item.split(':', 1)
+        if key == BLOCK:
+            offset, size, block_hash = value.split(':')
+            blocks.append((int(offset), int(size), block_hash))
+        else:
+            digests[key] = value
+    return digests, blocks
+
+
+def read_exactly(file, size):
+    """
+    @param file: a binary file like object, e.g. from socket.makefile
+    @param size: number of bytes
+    @return: exactly size bytes
+    @raise EOFError: if the stream ended before
+    """
+    data = file.read(size)
+    if len(data) != size:
+        raise EOFError('Connection closed after %s of %s bytes' % (len(data), size))
+    return data
+
+
+def read_requests(file):
+    """
+    @param file: a binary file like object the MAGIC was already read from
+    @return: generator yielding (server_id, offset, length) until the terminating frame,
+             length is None for "up to the end of the file" or DIGEST
+    """
+    while True:
+        server_id, offset, length = REQUEST.unpack(read_exactly(file, REQUEST.size))
+        if server_id == END:
+            return
+        yield server_id, offset, None if length == -1 else length
+
+
+def read_chunks(file, chunk_size, offset=0, length=None):
+    """
+    @param file: a file opened in binary mode
+    @param chunk_size: the maximum size of a chunk
+    @param offset: the position of the first byte
+    @param length: the number of bytes, None reads up to the end of the file
+    @return: generator yielding the chunks of the requested range
+    """
+    file.seek(offset)
+    while length is None or length > 0:
+        chunk = file.read(chunk_size if length is None else min(chunk_size, length))
+        if not chunk:
+            return
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
+
+
+def frames(server_id, chunks):
+    """
+    @param server_id: the database server_id the chunks belong to
+    @param chunks: iterable of bytes
+    @return: generator yielding the DATA frames for the chunks, including the terminating one,
+             ends with an ERROR frame if chunks raised an exception
+    """
+    try:
+        for chunk in chunks:
+            yield DATA.pack(server_id, len(chunk)) + chunk
+    except Exception as e:
+        logger.exception(e)
+        yield DATA.pack(server_id, ERROR)
+        return
+    yield DATA.pack(server_id, 0)
@@ -5,37 +5,291 @@ This is the scanner daemon, basically just a filesystem walker that checks if th
 and requests others to do the updates if necessary.
 """
 
+from collections import defaultdict, namedtuple, OrderedDict
 from datetime import datetime
-from queue import Queue
-from threading import Thread
+from functools import partial
+from heapq import heappush, heappop
+from itertools import count
+from queue import Queue, Full
+from threading import Thread, Lock, Condition
 import time
 import logging
-from os import listdir
+import os
+from os import scandir
 from pathlib import Path
+from stat import S_ISDIR, S_ISREG
 
 from sqlalchemy.orm.exc import NoResultFound
 
-from base import Folder, FilesystemObject
+from base import Folder, HashRequest, fix_encoding, restore_utf8, PATH_INDEX, CHILD_TYPES, FOLDER_OBSERVERS
 import config
 import database
+import devices
 import database_logging
+from watcher import Watcher
 
 
 __author__ = 'konsti'
 
 logger = logging.getLogger(__name__)
 
+# A directory waiting to be scanned, the stat result taken while its parent was listed,
+# whether it belongs to a full round, which lists even the directories whose mtime did not change,
+# and whether its known subfolders are scanned as well, new subfolders are always scanned
+ScanItem = namedtuple('ScanItem', ['path', 'stat', 'full', 'descend'])
+
+# The maximum number of directories of a device waiting to be scanned, further ones are scanned by the worker
+# that found them
+SCAN_QUEUE_SIZE = 10000
+
+# Directories modified within this many seconds are scanned before the others
+RECENT_CHANGE = 3600
+
+# Every this many rounds is a full round, the others only list directories whose mtime changed
+# and miss files that were modified in place
+FULL_SCAN_EVERY = 12
+
+
+class RequestBuffer(object):
+    """
+    Collects the new HashRequests of all workers and writes them with bulk inserts,
+    together with the mtimes of the listed folders, so a folder whose requests got lost is listed again.
+    There is at most one request per file, a folder listed again before the flush must skip its pending files.
+    The requests of deleted folders are dropped, see Folder.delete_by_ids.
+    @param size: the buffer is flushed when it holds this many requests
+    @param window: the buffer is flushed when its oldest request is older than this many seconds
+    @param on_lost: called with the paths of the folders whose requests could not be written,
+                    they have to be listed again, without a watch the next scan round would do it
+    """
+
+    def __init__(self, size=1000, window=10, on_lost=None):
+        self.size = size
+        self.window = window
+        self.on_lost = on_lost
+        self._mappings = OrderedDict()
+        self._mtimes = dict()
+        # folder_id -> names of the files whose requests are buffered or being inserted
+        self._pending = defaultdict(set)
+        self._since = None
+        self._lock = Lock()
+        FOLDER_OBSERVERS.add(self)
+
+    def __len__(self):
+        return len(self._mappings)
+
+    def add_all(self, mappings, folder_id=None, mtime=None):
+        """
+        @param mappings: list of dicts with the column values of new HashRequests
+        @param folder_id: id of the listed Folder, its mtime is stored in the same transaction as the requests
+        @param mtime: the mtime of the listed Folder
+        """
+        if not mappings:
+            return
+        with self._lock:
+            for mapping in mappings:
+                key = (mapping['folder_id'], mapping['name'])
+                self._mappings[key] = mapping
+                self._pending[key[0]].add(key[1])
+            if folder_id is not None:
+                self._mtimes[folder_id] = mtime
+            if self._since is None:
+                self._since = time.time()
+            full = len(self._mappings) >= self.size or time.time() - self._since >= self.window
+        if full:
+            self.flush()
+
+    def pending(self, folder_id):
+        """
+        Call it before reading the children of the folder, files that stop being pending afterwards are committed
+        @param folder_id: id of a Folder
+        @return: set of the names of its files whose requests are buffered or being inserted
+        """
+        with self._lock:
+            return set(self._pending.get(folder_id, ()))
+
+    def forget_folders(self, folder_ids):
+        """
+        Drops the buffered requests and mtimes of deleted folders
+        @param folder_ids: ids of the deleted Folders
+        """
+        folder_ids = set(folder_ids)
+        with self._lock:
+            for key in [key for key in self._mappings if key[0] in folder_ids]:
+                del self._mappings[key]
+            for folder_id in folder_ids:
+                self._mtimes.pop(folder_id, None)
+                self._pending.pop(folder_id, None)
+            if not self._mappings:
+                self._since = None
+
+    def flush(self):
+        """
+        Inserts all buffered requests and updates the mtimes of their folders in a single transaction,
+        the requests of folders that were deleted meanwhile are dropped.
+        If the transaction fails anyway the folders are passed to on_lost.
+        """
+        with self._lock:
+            mappings, self._mappings, self._since = self._mappings, OrderedDict(), None
+            mtimes, self._mtimes = self._mtimes, dict()
+        if not mappings:
+            return
+        logger.debug('Inserting %s HashRequests' % len(mappings))
+        lost = False
+        session = database.get_thread_session()
+        try:
+            existing = Folder.existing_ids({folder_id for folder_id, _ in mappings}, session)
+            session.bulk_insert_mappings(HashRequest, [mapping for (folder_id, _), mapping in mappings.items()
+                                                       if folder_id in existing])
+            folders = defaultdict(list)
+            for folder_id, mtime in mtimes.items():
+                if folder_id in existing:
+                    folders[mtime].append(folder_id)
+            for mtime, folder_ids in folders.items():
+                Folder.set_mtime(folder_ids, mtime, session)
+            session.commit()
+        except Exception as e:
+            # The mtimes of the folders stay old, they are listed again
+            logger.exception(e)
+            session.rollback()
+            lost = True
+        finally:
+            session.close()
+            with self._lock:
+                for folder_id, name in mappings:
+                    if (folder_id, name) not in self._mappings:
+                        self._pending[folder_id].discard(name)
+                        if not self._pending[folder_id]:
+                            del self._pending[folder_id]
+        if lost and self.on_lost is not None:
+            self.on_lost(sorted({os.path.dirname(mapping['path']) for mapping in mappings.values()}))
+
+
+class ScanQueue(Queue):
+    """
+    A bounded queue of ScanItems, recently changed directories come first and the others in path order,
+    so siblings are scanned together and the scan proceeds depth first instead of jumping across the disk
+    @param maxsize: put blocks and put_nowait raises Full while this many items are waiting
+    @param recent: directories modified within this many seconds are recently changed
+    """
+
+    def __init__(self, maxsize=SCAN_QUEUE_SIZE, recent=RECENT_CHANGE):
+        self.recent = recent
+        self._counter = count()
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self.queue = list()
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        recent = item.stat is not None and time.time() - item.stat.st_mtime < self.recent
+        heappush(self.queue, (not recent, item.path.parts, next(self._counter), item))
+
+    def _get(self):
+        return heappop(self.queue)[-1]
+
+
+class DeviceQueues(object):
+    """
+    Routes the ScanItems to one ScanQueue per device, every queue has its own Workers,
+    so the number of concurrent scans follows the storage, see devices.scan_workers
+    @param buffer: the RequestBuffer passed to the Workers
+    @param workers: Number of Workers per device, None to choose it per device
+    """
+
+    def __init__(self, buffer, workers=None):
+        self._buffer = buffer
+        self._workers = workers
+        self._queues = dict()
+        self._lock = Lock()
+        self._done = Condition(self._lock)
+        self._unfinished = 0
+
+    def _queue(self, item: ScanItem):
+        """
+        @return: the ScanQueue of the device of item, it is created with its Workers on first use
+        """
+        st_dev = item.stat.st_dev
+        with self._lock:
+            queue = self._queues.get(st_dev)
+        if queue is not None:
+            return queue
+        # telling the device apart can take several listings on network storage,
+        # the workers of the other devices must not wait for the lock meanwhile
+        workers = self._workers or devices.scan_workers(str(item.path), st_dev)
+        with self._lock:
+            queue = self._queues.get(st_dev)
+            if queue is not None:
+                # another thread was faster
+                return queue
+            queue = self._queues[st_dev] = ScanQueue()
+        # every worker holds a connection while it lists a directory
+        init(database.reserve(workers), self, self._buffer, queue)
+        return queue
+
+    def put(self, item: ScanItem, block=True):
+        """
+        @param item: a Folder
+        @param block: wait until there is space in the queue of its device
+        @raise Full: if block is False and the queue of its device is full
+        """
+        queue = self._queue(item)
+        with self._lock:
+            self._unfinished += 1
+        try:
+            queue.put(item, block)
+        except Full:
+            self.task_done()
+            raise
+
+    def put_nowait(self, item: ScanItem):
+        """
+        @param item: a Folder
+        @raise Full: if the queue of its device is full
+        """
+        self.put(item, False)
+
+    def task_done(self):
+        """
+        Called by the Workers for every item they got
+        """
+        with self._lock:
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._done.notify_all()
+
+    def empty(self):
+        """
+        @return: True if no item is waiting or being scanned on any device
+        """
+        with self._lock:
+            return not self._unfinished
+
+    def join(self):
+        """
+        Blocks until all items of all devices are scanned, including the items they produced on other devices
+        """
+        with self._lock:
+            while self._unfinished:
+                self._done.wait()
+
 
 class Worker(object):
     """
     scans a directory consumed from queue
     """
 
-    def __init__(self, queue: Queue):
+    def __init__(self, queue: Queue, buffer: RequestBuffer, inbox: Queue=None):
         """
-        @param queue: The queue new consumed are consumed from
+        @param queue: The queue new subfolders are put into, task_done is called on it
+        @param buffer: The buffer new HashRequests are collected in
+        @param inbox: The queue folders are consumed from, defaults to queue
         """
         self._queue = queue
+        self._inbox = queue if inbox is None else inbox
+        self._buffer = buffer
         self._thread = Thread(target=self._loop)
         self._thread.daemon = True
 
@@ -47,117 +301,246 @@ class Worker(object):
         Executes the daemon loop
         """
         while True:
-            item = self._queue.get(block=True)
+            pending = [self._inbox.get(block=True)]
             try:
-                self._scan(item)
-            except Exception as e:
-                logging.exception(e)
-                time.sleep(30)
+                # the subfolders that do not fit into the queue are scanned by this worker, depth first
+                while pending:
+                    item = pending.pop()
+                    try:
+                        pending.extend(reversed(self._scan(item)))
+                    except Exception as e:
+                        logging.exception(e)
+                        time.sleep(30)
             finally:
                 self._queue.task_done()
 
-    def _scan(self, item: Path):
+    def _scan(self, item: ScanItem):
         """
-        @param item: a File or a Folder
+        @param item: a Folder, Files are reconciled together with their parent
+        @return: list of the ScanItems of the subfolders that did not fit into the queue
         """
-        if item.is_dir():
-            self._scan_folder(item)
-        elif item.is_file():
-            self._scan_file(item)
+        return self._scan_folder(item)
 
-    def _scan_file(self, file: Path):
+    def _scan_folder(self, item: ScanItem):
         """
-        @param file: a File
+        Compares the content of a directory with its database representation and writes all differences back
+        in a single transaction. Directories whose mtime did not change since their last scan are not listed
+        unless the item belongs to a full round, their subfolders are scanned nevertheless.
+        The mtime of a directory with new requests is stored by the RequestBuffer together with the requests.
+        @param item: a Folder
+        @return: list of the ScanItems of the subfolders that did not fit into the queue
         """
-
-        logger.debug('Scanning File: %s' % file)
-        session = database.get_session(new_engine=False)
+        folder = item.path
+        logger.debug('Scanning Folder: %s' % folder)
+        session = database.get_thread_session()
         try:
-            db_item = FilesystemObject.by_uri('%s::%s' % (config.HOSTNAME, file), session)
-        except NoResultFound:
-            self._add_child(file)
-            session.close()
-            return
+            try:
+                db_folder = Folder.by_uri('%s::%s' % (config.HOSTNAME, folder), session)
+            except NoResultFound:
+                logger.warning('Folder vanished before it could be scanned: %s' % folder)
+                return list()
 
-        if file.stat().st_size == db_item.size and datetime.fromtimestamp(file.stat().st_mtime) == db_item.mtime:
-            pass
-        else:
-            session.delete(db_item)
+            folder_id = db_folder.id
+            mtime = datetime.fromtimestamp(item.stat.st_mtime)
+            if not item.full and db_folder.mtime == mtime:
+                logger.debug('Folder unchanged: %s' % folder)
+                requests, pending = list(), set()
+                subfolders = self._known_subfolders(item, db_folder, session) if item.descend else list()
+            else:
+                pending = self._buffer.pending(folder_id)
+                requests, subfolders = self._reconcile(item, db_folder, session, pending)
+                if not requests and not pending:
+                    db_folder.mtime = mtime
             session.commit()
-            self._queue.put(file)
-            logging.info('Cache mismatch: %r' % db_item)
-        session.close()
+        except Exception as error:
+            session.rollback()
+            raise error
+        finally:
+            session.close()
+
+        # with requests of an earlier listing still pending the mtime is left alone, the folder is listed again
+        self._buffer.add_all(requests, None if pending else folder_id, mtime)
+        overflow = list()
+        for subfolder in subfolders:
+            # a worker must never block on the queue, all of them could wait for each other
+            try:
+                self._queue.put_nowait(subfolder)
+            except Full:
+                overflow.append(subfolder)
+        return overflow
 
-    def _scan_folder(self, folder: Path):
+    @staticmethod
+    def _reconcile(item: ScanItem, db_folder: Folder, session, pending=()):
         """
-        @param folder: a Folder
+        Lists the directory and writes the differences to its children to the session,
+        every entry is stat'ed exactly once, the results of the subfolders are passed along with them.
+        @param item: a Folder
+        @param db_folder: its database representation
+        @param session: The Session used for Querying
+        @param pending: names of the files whose requests are still in the RequestBuffer, they are not requested again
+        @return: (list of the mappings of new HashRequests, list of ScanItems of the subfolders)
         """
-        logger.debug('Scanning Folder: %s' % folder)
-        session = database.get_session(new_engine=False)
-        try:
-            FilesystemObject.by_uri('%s::%s' % (config.HOSTNAME, folder), session)
-        except NoResultFound:
-            self._add_child(folder)
-        finally:
-            session.close()
+        folder = item.path
+        children = db_folder.children(session)
+        stale = defaultdict(list)
+        new_folders = list()
+        requests = list()
+        subfolders = list()
+
+        for entry in scandir(str(folder)):
+            name = fix_encoding(entry.name)
+            child = children.pop(name, None)
+            try:
+                # cached by the DirEntry, is_dir and is_file would stat again on filesystems without d_type
+                stat = entry.stat()
+            except OSError as e:
+                logger.debug('%s can not be stat\'ed: %s' % (folder / entry.name, e))
+                stat = None
+            if stat is not None and S_ISDIR(stat.st_mode):
+                if child is not None and child.type == 'folder':
+                    if item.descend:
+                        subfolders.append(ScanItem(folder / entry.name, stat, item.full, True))
+                    continue
+                subfolders.append(ScanItem(folder / entry.name, stat, item.full, True))
+                new_folders.append(db_folder.add_folder(name))
+            elif stat is not None and S_ISREG(stat.st_mode):
+                mtime = datetime.fromtimestamp(stat.st_mtime)
+                if child is not None and child.type != 'folder':
+                    if child.size == stat.st_size and child.mtime == mtime:
+                        continue
+                    logging.info('Cache mismatch: %s' % (folder / entry.name))
+                elif child is None and name in pending:
+                    continue
+                requests.append(dict(name=name, path='%s%s' % (db_folder.path, restore_utf8(name)), mtime=mtime,
+                                     size=stat.st_size, host_id=db_folder.host_id, folder_id=db_folder.id,
+                                     locked=False))
+            else:
+                logger.debug('%s is neither File nor Folder' % (folder / entry.name))
+                continue
+            if child is not None:
+                stale[child.type].append(child.id)
 
-        for child_name in listdir(str(folder)):
-            self._queue.put(folder / child_name)
+        for child in children.values():
+            logger.info('Removing Item: [%s]' % (folder / restore_utf8(child.name)))
+            stale[child.type].append(child.id)
 
-    def _add_child(self, path: Path):
+        for child_type, ids in stale.items():
+            CHILD_TYPES[child_type].delete_by_ids(ids, session)
+        session.add_all(new_folders)
+        session.flush()
+        for new_folder in new_folders:
+            PATH_INDEX.put(db_folder.host_id, new_folder.path, new_folder.id)
+        return requests, subfolders
+
+    @staticmethod
+    def _known_subfolders(item: ScanItem, db_folder: Folder, session):
         """
-        Adds a Directory to the Database
-        @param path: a pathlib Path object
+        @param item: an unchanged Folder
+        @param db_folder: its database representation
+        @param session: The Session used for Querying
+        @return: list of ScanItems of the subfolders stored in the database
         """
-        logger.info('Adding Item: [%r]' % path)
-        session = database.get_session(new_engine=False)
-        parent = Folder.by_uri('%s::%s' % (config.HOSTNAME, path.parent), session)
-        if path.is_dir():
-            child = parent.add_folder(path.name)
-            self._queue.put(path)
-        elif path.is_file():
-            child = parent.add_file(name=path.name, mtime=datetime.fromtimestamp(path.stat().st_mtime),
-                                    size=path.stat().st_size, fhash=None)
-        else:
-            session.close()
-            raise RuntimeError('%s is neither File nor Folder' % path)
-        session.add(child)
-        session.commit()
-        session.close()
+        subfolders = list()
+        for path, in session.query(Folder.path).filter(Folder.parent_id == db_folder.id):
+            subfolder = Path(path)
+            try:
+                subfolders.append(ScanItem(subfolder, subfolder.stat(), item.full, True))
+            except OSError as e:
+                # it was replaced by something else within the mtime granularity, the next full round fixes it
+                logger.debug('%s can not be stat\'ed: %s' % (subfolder, e))
+        return subfolders
 
 
-def run(folder, interval):
+def run(folder, interval, full_every=FULL_SCAN_EVERY, watch=False, workers=None):
     """
-    @param folder: The Folder that should be Scanned
+    @param folder: The Folder that should be Scanned or its path
     @param interval: The interval in which it should be scanned, None if only once, else the time in seconds
+    @param full_every: every this many rounds is a full round, the first one is always full
+    @param watch: scan the directories inotify reports as changed, the tree is only walked in the first round,
+                  after lost events and, if the watch limit is hit, every interval like without watch
+    @param workers: Number of worker Threads per device, None to choose it by the kind of the device
     """
 
     database_logging.configure_logger()
     logging.info('Scanner started with: folder=%s, interval=%s' % (folder, interval))
 
-    folder = Path(folder.path)
+    folder = Path(getattr(folder, 'path', folder))
+
+    # this thread flushes the buffer
+    database.reserve(1)
+    buffer = RequestBuffer()
+    dir_queue = DeviceQueues(buffer, workers)
+    buffer.on_lost = partial(_put_lost, dir_queue)
 
-    dir_queue = Queue()
-    init(workers=40, queue=dir_queue)
+    watcher = None
+    if watch:
+        watcher = Watcher(str(folder), partial(_put_changed, dir_queue))
+        if not watcher.start():
+            logging.warning('Falling back to periodic scans of %s' % folder)
+            watcher = None
 
+    rounds = 0
     while True:
-        start = datetime.now()
-        if dir_queue.empty():  # Only add the Root folder if the Queue is empty.
-            dir_queue.put(folder)
-        dir_queue.join()
-        logging.debug('Scanner round Completed in %s' % (datetime.now() - start))
+        lost = watcher is not None and watcher.needs_walk()
+        watching = watcher is not None and watcher.alive
+        if rounds == 0 or lost or not watching:
+            start = datetime.now()
+            # lost events may include files modified in place
+            full = lost or watching or rounds % full_every == 0
+            if dir_queue.empty():  # Only add the Root folder if the Queue is empty.
+                dir_queue.put(ScanItem(folder, folder.stat(), full, True))
+            dir_queue.join()
+            rounds += 1
+            logging.debug('Scanner round Completed in %s, full: %s' % (datetime.now() - start, full))
+        buffer.flush()
         if interval is None:
             break  # This is used for debugging
-        time.sleep(interval)
+        # the requests of reported directories should not wait for a whole interval in the buffer
+        time.sleep(min(interval, buffer.window) if watching else interval)
+
+
+def _put_changed(queue, path):
+    """
+    Queues a directory reported by the Watcher, it is listed even if its mtime did not change,
+    because files modified in place do not change it
+    @param queue: the queue of the workers
+    @param path: the path of the changed directory
+    """
+    path = Path(path)
+    try:
+        queue.put(ScanItem(path, path.stat(), True, False))
+    except OSError as e:
+        # it vanished, its parent was reported as well
+        logger.debug('%s can not be stat\'ed: %s' % (path, e))
+
+
+def _put_lost(queue, paths):
+    """
+    Queues the directories whose requests could not be written, they are listed even if their mtime did not change.
+    Called by the thread that flushed the buffer, which may be a worker, so it never blocks
+    @param queue: the queue of the workers
+    @param paths: the paths of the directories
+    """
+    for path in paths:
+        path = Path(path)
+        try:
+            queue.put_nowait(ScanItem(path, path.stat(), True, False))
+        except OSError as e:
+            # it vanished, there is nothing left to request
+            logger.debug('%s can not be stat\'ed: %s' % (path, e))
+        except Full:
+            logger.warning('%s is listed again in the next full round' % path)
 
 
-def init(workers, queue):
+def init(workers, queue, buffer, inbox=None):
     """
     Starts the worker Threads
     @param queue: the queue passed to the Worker Threads
+    @param buffer: the RequestBuffer passed to the Worker Threads
     @param workers: Number of worker Threads
+    @param inbox: the queue the Worker Threads consume from, defaults to queue
     """
     worker_threads = list()
     for _ in range(workers):
-        worker_threads.append(Worker(queue))
+        worker_threads.append(Worker(queue, buffer, inbox))
 
@@ -4,7 +4,11 @@
 This module searches for files that need to be served to a hasher and does so
 """
 import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
 import logging
+import os
+from queue import Queue, Empty
 import socket
 import socketserver
 import sys
@@ -15,12 +19,23 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, subqueryload
 from sqlalchemy.orm.exc import NoResultFound
 
-from base import Host, Server
+import base
+from base import Host, Server, HashRequest
+import hasher
+import protocol
 
 
 __author__ = 'konsti'
 logger = logging.getLogger(__name__)
 
+# Size of the chunks used if sendfile is not available
+CHUNK_SIZE = 2 ** 14
+# Size of the chunks read by the AsyncServer
+ASYNC_CHUNK_SIZE = 2 ** 18
+# Size of the chunks and number of frames a pipelined connection reads ahead of the network
+PIPELINE_CHUNK_SIZE = 2 ** 18
+PIPELINE_DEPTH = 16
+
 
 class TCPRequestHandler(socketserver.StreamRequestHandler):
     """
@@ -29,23 +44,129 @@ class TCPRequestHandler(socketserver.StreamRequestHandler):
 
     def handle(self):
         """
-        Called by super
+        Called by super, the request is either a line "<server_id>[ <offset>[ <length>]]",
+        offset and length select a byte range of the file, or a pipelined request as defined in protocol.
         """
         logger.info('Serving Request from %s:%s' % self.client_address)
         session = self.server.session_maker()
         try:
-
-            server_id = int(self.rfile.readline().strip())
+            if self.rfile.peek(1)[:1] == protocol.MAGIC[:1]:
+                if protocol.read_exactly(self.rfile, len(protocol.MAGIC)) != protocol.MAGIC:
+                    raise ValueError('Invalid protocol from %s:%s' % self.client_address)
+                self._handle_pipelined(session)
+                return
+            request = self.rfile.readline().split()
+            server_id = int(request[0])
+            offset = int(request[1]) if len(request) > 1 else 0
+            count = int(request[2]) if len(request) > 2 else None
             server = Server.by_id(server_id, session)
             with open(server.request.path, 'rb') as data:
-                for chunk in iter(lambda: data.read(2 ** 14), b''):
-                    self.request.sendall(chunk)
+                send_file(self.request, data, offset, count)
         except Exception as e:
             logger.exception(e)
         finally:
             session.close()
             self.request.close()
 
+    def _handle_pipelined(self, session):
+        """
+        Reads the requested files in a second thread, which stays up to PIPELINE_DEPTH frames
+        ahead of the network, and sends the frames in this one.
+        @param session: The Session used for Querying, only used by the reading thread
+        """
+        pipeline = Queue(maxsize=PIPELINE_DEPTH)
+        stop = threading.Event()
+
+        def read_ahead():
+            """
+            Fills the pipeline, None marks the end
+            """
+            try:
+                for server_id, offset, length in protocol.read_requests(self.rfile):
+                    get_path = lambda: Server.by_id(server_id, session).request.path
+                    if length == protocol.DIGEST:
+                        chunks = digest_chunks(get_path, getattr(self.server, 'hash_pool', None))
+                    else:
+                        chunks = file_chunks(get_path, offset, length)
+                    for frame in protocol.frames(server_id, chunks):
+                        if stop.is_set():
+                            return
+                        pipeline.put(frame)
+            except Exception as error:
+                logger.exception(error)
+            finally:
+                pipeline.put(None)
+
+        reader = threading.Thread(target=read_ahead)
+        reader.daemon = True
+        reader.start()
+        try:
+            for frame in iter(pipeline.get, None):
+                self.request.sendall(frame)
+        finally:
+            stop.set()
+            while reader.is_alive():
+                try:
+                    pipeline.get(timeout=1)
+                except Empty:
+                    pass
+
+
+def file_chunks(get_path, offset=0, length=None):
+    """
+    @param get_path: callable returning the path of the file, called on the first iteration
+    @param offset: the position of the first byte
+    @param length: the number of bytes, None reads up to the end of the file
+    @return: generator yielding the chunks of the requested range of the file
+    """
+    with open(get_path(), 'rb') as data:
+        for chunk in protocol.read_chunks(data, PIPELINE_CHUNK_SIZE, offset, length):
+            yield chunk
+
+
+def digest_chunks(get_path, pool=None):
+    """
+    @param get_path: callable returning the path of the file, called on the first iteration
+    @param pool: optional Executor the file is hashed in
+    @return: generator yielding the digests of the file as the only chunk, see protocol.format_digests
+    """
+    path = get_path()
+    if pool is None:
+        digests = hasher.calculate_local_hash(path, hasher.HASH_ALGORITHMS, hasher.BLOCK_SIZE)
+    elif hasher.is_parallel(os.path.getsize(path)):
+        digests = hasher.calculate_parallel_hash(path, pool)
+    else:
+        digests = pool.submit(hasher.calculate_local_hash, path, hasher.HASH_ALGORITHMS,
+                              hasher.BLOCK_SIZE).result()
+    yield protocol.format_digests(digests, digests.blocks)
+
+
+def send_file(sock, file, offset=0, count=None):
+    """
+    Sends a file with sendfile, so the data doesn't pass through user space,
+    falls back to sending chunks if the platform doesn't support it.
+    @param sock: a connected socket
+    @param file: a file opened in binary mode
+    @param offset: the position of the first byte that is sent
+    @param count: the number of bytes that are sent, None sends everything up to the end of the file
+    @return: the number of bytes sent
+    """
+    if count == 0:
+        # sendfile rejects a count of 0
+        return 0
+    if hasattr(sock, 'sendfile'):
+        return sock.sendfile(file, offset, count)
+
+    file.seek(offset)
+    sent = 0
+    while count is None or sent < count:
+        chunk = file.read(CHUNK_SIZE if count is None else min(CHUNK_SIZE, count - sent))
+        if not chunk:
+            break
+        sock.sendall(chunk)
+        sent += len(chunk)
+    return sent
+
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     """
@@ -54,6 +175,160 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     pass
 
 
+class AsyncServer(object):
+    """
+    asyncio based alternative to ThreadedTCPServer, all connections are served by one thread running an event loop.
+    The paths of the announced requests are cached, so most connections don't touch the database at all.
+    @param session_maker: used to look up paths that are not cached
+    @param limit: the maximum number of connections served at once, further connections wait
+    @param hash_pool: optional Executor used to answer digest requests
+    """
+
+    def __init__(self, session_maker, limit=1000, hash_pool=None):
+        self.session_maker = session_maker
+        self.limit = limit
+        self.hash_pool = hash_pool
+        self.server_address = None
+        self._paths = dict()
+        self._loop = None
+        self._semaphore = None
+
+    def start(self, host, port):
+        """
+        Starts the event loop in a daemon thread
+        @param host: the hostname or ip to listen on
+        @param port: the port to listen on, 0 picks a free one
+        @return: the thread running the loop
+        """
+        ready = threading.Event()
+        thread = threading.Thread(target=self._serve, args=(host, port, ready))
+        thread.daemon = True
+        thread.start()
+        ready.wait()
+        return thread
+
+    def _serve(self, host, port, ready):
+        """
+        Runs the event loop, called by start
+        """
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.limit)
+        server = self._loop.run_until_complete(asyncio.start_server(self.handle, host, port))
+        self.server_address = server.sockets[0].getsockname()[:2]
+        ready.set()
+        self._loop.run_forever()
+
+    def shutdown(self):
+        """
+        Stops the event loop
+        """
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def update_paths(self, host_id, session):
+        """
+        Caches the paths of all requests of the host that are announced, with a single query
+        @param host_id: the id of the served host
+        @param session: The Session used for Querying
+        """
+        query = session.query(Server.id, HashRequest.path).join(Server.request).filter(HashRequest.host_id == host_id)
+        self._paths = dict(query)
+
+    def path(self, server_id):
+        """
+        @param server_id: the database server_id
+        @return: the path of the file announced by this Server
+        """
+        try:
+            return self._paths[server_id]
+        except KeyError:
+            session = self.session_maker()
+            try:
+                path = Server.by_id(server_id, session).request.path
+            finally:
+                session.close()
+            self._paths[server_id] = path
+            return path
+
+    async def handle(self, reader, writer):
+        """
+        Serves one connection, understands the same requests as TCPRequestHandler.
+        Waits for the client to drain the socket before the next chunk is read.
+        """
+        await self._semaphore.acquire()
+        try:
+            logger.info('Serving Request from %s:%s' % writer.get_extra_info('peername')[:2])
+            first = await reader.readexactly(1)
+            if first == protocol.MAGIC[:1]:
+                if first + (await reader.readexactly(len(protocol.MAGIC) - 1)) != protocol.MAGIC:
+                    raise ValueError('Invalid protocol')
+                await self._handle_pipelined(reader, writer)
+                return
+            request = (first + (await reader.readline())).split()
+            server_id = int(request[0])
+            offset = int(request[1]) if len(request) > 1 else 0
+            count = int(request[2]) if len(request) > 2 else None
+            path = await self._loop.run_in_executor(None, self.path, server_id)
+            with open(path, 'rb') as data:
+                data.seek(offset)
+                while count is None or count > 0:
+                    size = ASYNC_CHUNK_SIZE if count is None else min(ASYNC_CHUNK_SIZE, count)
+                    chunk = await self._loop.run_in_executor(None, data.read, size)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+                    await writer.drain()
+                    if count is not None:
+                        count -= len(chunk)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            writer.close()
+            self._semaphore.release()
+
+    async def _handle_pipelined(self, reader, writer):
+        """
+        Serves a pipelined connection, a second task reads the files up to PIPELINE_DEPTH frames
+        ahead of the network.
+        """
+        pipeline = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+        task = self._loop.create_task(self._read_ahead(reader, pipeline))
+        try:
+            while True:
+                frame = await pipeline.get()
+                if frame is None:
+                    break
+                writer.write(frame)
+                await writer.drain()
+        finally:
+            task.cancel()
+
+    async def _read_ahead(self, reader, pipeline):
+        """
+        Fills the pipeline with the frames of the requested files, None marks the end
+        """
+        try:
+            while True:
+                server_id, offset, length = protocol.REQUEST.unpack(await reader.readexactly(protocol.REQUEST.size))
+                if server_id == protocol.END:
+                    break
+                if length == protocol.DIGEST:
+                    chunks = digest_chunks(lambda: self.path(server_id), self.hash_pool)
+                else:
+                    chunks = file_chunks(lambda: self.path(server_id), offset, None if length < 0 else length)
+                frames = protocol.frames(server_id, chunks)
+                while True:
+                    frame = await self._loop.run_in_executor(None, next, frames, None)
+                    if frame is None:
+                        break
+                    await pipeline.put(frame)
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            logger.exception(e)
+        await pipeline.put(None)
+
+
 def announce_server(request, ip, port, session):
     """
     Creates a database entry to announce the server is severing a file
@@ -70,6 +345,53 @@ def announce_server(request, ip, port, session):
         return s
 
 
+def hash_requests(host, pool, size, session):
+    """
+    Hashes a batch of the host's own requests in the pool and writes the Files directly,
+    so the file contents never cross the network.
+    @param host: the local Host
+    @param pool: the Executor the files are hashed in
+    @param size: the number of requests claimed at once
+    @param session: The Session used for Querying
+    @return: the number of claimed requests
+    """
+    request_ids = HashRequest.claim(host, size, hasher.LEASE, session, own=True)
+    session.commit()
+    if not request_ids:
+        return 0
+    requests = session.query(HashRequest).filter(HashRequest.id.in_(request_ids)).all()
+    # the small files are hashed one per process, the ranges of the large ones are queued behind them
+    futures = {request.id: pool.submit(hasher.calculate_local_hash, request.path, hasher.HASH_ALGORITHMS,
+                                       hasher.BLOCK_SIZE)
+               for request in requests if not hasher.is_parallel(request.size)}
+    for request in requests:
+        try:
+            if request.id in futures:
+                hashes = futures[request.id].result()
+            else:
+                hashes = hasher.calculate_parallel_hash(request.path, pool)
+            hasher.fulfill(request, hashes, session)
+        except OSError as e:
+            # The request stays leased, it is retried when the lease expires
+            logger.exception(e)
+    session.commit()
+    return len(requests)
+
+
+def device_count(host):
+    """
+    @param host: the local Host
+    @return: the number of distinct devices the roots of the host are stored on, at least 1
+    """
+    devices = set()
+    for root in host.roots:
+        try:
+            devices.add(os.stat(root.path).st_dev)
+        except OSError as e:
+            logger.warning(e)
+    return max(len(devices), 1)
+
+
 def daemon(args):
     """
     @param args: Args namespace as returned by argparse
@@ -79,13 +401,34 @@ def daemon(args):
     session_maker = sessionmaker(bind=database)
     session = session_maker()
 
-    host = session.query(Host).options(subqueryload(Host.requests)).filter(Host.name == socket.gethostname()).first()
-    server = ThreadedTCPServer((socket.gethostname(), args.port), TCPRequestHandler)
-    server.session_maker = session_maker
-    server_thread = threading.Thread(target=server.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
-    logger.info('Starting TCPServer in thread: %s' % server_thread.name)
+    host = session.query(Host).options(subqueryload(Host.requests)).filter(Host.name == args.name).first()
+    if host is None:
+        raise ValueError('The host %s is not registered, add it with the configurator' % args.name)
+    pool = ProcessPoolExecutor(args.processes or device_count(host))
+
+    if args.hash:
+        logger.info('Hashing requests locally')
+        while True:
+            try:
+                if hash_requests(host, pool, args.processes or device_count(host), session):
+                    continue
+            except Exception as e:
+                logger.exception(e)
+                session.rollback()
+            sleep(args.interval)
+
+    if args.asyncio:
+        server = AsyncServer(session_maker, args.connections, pool)
+        server_thread = server.start(socket.gethostname(), args.port)
+        logger.info('Starting AsyncServer in thread: %s' % server_thread.name)
+    else:
+        server = ThreadedTCPServer((socket.gethostname(), args.port), TCPRequestHandler)
+        server.session_maker = session_maker
+        server.hash_pool = pool
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        logger.info('Starting TCPServer in thread: %s' % server_thread.name)
     ip, port = server.server_address
 
     while True:
@@ -96,6 +439,8 @@ def daemon(args):
                 announces.append(announce_server(request, ip, port, session))
             session.add_all(filter(None, announces))
             session.commit()
+            if args.asyncio:
+                server.update_paths(host.id, session)
         except Exception as e:
             logger.exception(e)
             session.rollback()
@@ -111,10 +456,29 @@ def main(args=sys.argv[1:]):
     parser = argparse.ArgumentParser(description='Scanner Tool')
     parser.add_argument('-d', '--database', type=str, metavar='"Connection String"', required=True)
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--name', type=str, metavar='"HOSTNAME"', default=None,
+                        help='The name the host is registered under, defaults to the machine name')
     parser.add_argument('-i', '--interval', type=int, metavar='SECONDS', default=360,
                         help='Interval between two Scan runs, defaults to 1 hour')
     parser.add_argument('-p', '--port', type=int, metavar='PORT', default=0)
+    parser.add_argument('--asyncio', action='store_true', help='Serve all connections from one event loop')
+    parser.add_argument('-c', '--connections', type=int, metavar='NUMBER', default=1000,
+                        help='Maximum number of connections served at once by the asyncio server')
+    parser.add_argument('--hash', action='store_true',
+                        help='Hash the requests of this host locally instead of serving them')
+    parser.add_argument('-n', '--processes', type=int, metavar='NUMBER', default=None,
+                        help='Number of hashing processes, defaults to the number of devices the roots are on')
+    parser.add_argument('-a', '--algorithm', action='append', choices=list(hasher.ALGORITHMS), dest='algorithms',
+                        help='Hash algorithm, repeat to compute several digests in one pass, the first is the primary')
+    parser.add_argument('--block-size', type=int, metavar='BYTES', default=None,
+                        help='Size of the blocks whose hashes are sent with the digests, 0 disables them, '
+                             'defaults to %s' % hasher.BLOCK_SIZE)
     args = parser.parse_args(args)
+    args.name = args.name or base.LOCAL_HOSTNAME
+    if args.algorithms:
+        hasher.HASH_ALGORITHMS = tuple(args.algorithms)
+    if args.block_size is not None:
+        hasher.BLOCK_SIZE = args.block_size
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
         logger.debug('Server started with following arguments: %s' % args)
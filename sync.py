@@ -4,14 +4,15 @@
 This is a Tool to Evaluate a Synctool database
 """
 import argparse
-from collections import namedtuple, Sequence
+from collections import defaultdict, namedtuple
+from collections.abc import Sequence
 import logging
 import sys
 
-from sqlalchemy import create_engine, and_
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, and_, or_, not_, func, literal, Unicode
+from sqlalchemy.orm import sessionmaker, aliased
 
-from base import Folder, File
+from base import Folder, File, HashRequest, Digest, Block
 import database_logging
 
 
@@ -19,91 +20,179 @@ __author__ = 'konsti'
 
 logger = logging.getLogger(__name__)
 
-Change = namedtuple('Change', ['type', 'source', 'target'])
+# source and target are paths, source is empty for DELETE, target_id is None for objects that don't exist yet,
+# the size of a DELTA is the size of the blocks that differ, see ChangeStream.delta
+Change = namedtuple('Change', ['type', 'source', 'target', 'source_id', 'target_id', 'size'])
 
+# Number of rows fetched at once while streaming the changes
+_YIELD_PER = 1000
 
-class ChangeSet(Sequence):
+# Sorts after every other character, a path followed by it is greater than every path below it
+_MAX_CHAR = '\U0010ffff'
+
+
+class ChangeStream(object):
     """
-    This is a list of changes that need to be made in order to sync to folders
+    The changes that need to be made in order to sync to folders, they are not materialized,
+    but computed again on every iteration
     @param source: the source folder
     @param dst: the target folder
     @param session: The Session used for Querying
     """
 
     def __init__(self, source, dst, session):
-        self.changes = self._get_changes(source, dst, session)
+        self.source = source
+        self.dst = dst
+        self.session = session
 
-    def __len__(self):
-        return self.changes.__len__()
-
-    def __getitem__(self, index):
-        return self.changes.__getitem__(index)
+    def __iter__(self):
+        return self._get_changes(self.source, self.dst, self.session)
 
     @staticmethod
     def _get_changes(source: Folder, dst: Folder, session):
-        changes = list()
-
-        for file in source.files:
-            dst_file = dst.child_by_name(file.name, session)
-            if dst_file is None:
-                dst_file = File(name=file.name, host=dst.host, folder=dst, hash=file.hash, mtime=file.mtime,
-                                size=file.size)
-                obj = session.query(File).filter(and_(File.hash == file.hash, File.host == dst.host)).first()
-                if obj is None:
-                    change = Change(type='COPY', source=file, target=dst_file)
-                else:
-                    change = Change(type='LCOPY', source=obj, target=dst_file)
-
+        """
+        Computes the changes with a few set based joins over the materialized paths of both trees,
+        the objects of both sides are matched by their path relative to source and dst.
+        @param source: the source folder
+        @param dst: the target folder
+        @param session: The Session used for Querying
+        @return: generator of Changes
+        """
+        for changes in (ChangeStream._new_folders(source, dst, session),
+                        ChangeStream._new_files(source, dst, session),
+                        ChangeStream._changed_files(source, dst, session),
+                        ChangeStream._deleted(File, dst, source, session),
+                        ChangeStream._deleted(Folder, dst, source, session)):
+            for change in changes:
                 logger.info('Adding change: %s' % str(change))
-                changes.append(change)
+                yield change
+
+    @staticmethod
+    def _new_folders(source, dst, session):
+        """
+        @return: COPY changes for the topmost source folders that are missing in dst
+        """
+        src_folder, src_parent, dst_parent, dst_folder = (aliased(Folder) for _ in range(4))
+        src_file = aliased(File)
+        # the size of every missing folder is summed up in the same grouped query
+        # noinspection PyComparisonWithNone,PyPep8
+        query = session.query(src_folder.id, src_folder.path, func.sum(src_file.size)) \
+            .join(src_parent, src_folder.parent_id == src_parent.id) \
+            .join(dst_parent, _counterpart(dst_parent, dst, src_parent, source)) \
+            .outerjoin(dst_folder, _counterpart(dst_folder, dst, src_folder, source)) \
+            .outerjoin(src_file, and_(_in_tree(src_file, source), _below(src_file, src_folder))) \
+            .filter(and_(_in_tree(src_folder, source), dst_folder.id == None)) \
+            .group_by(src_folder.id, src_folder.path).order_by(src_folder.path)
+        for folder_id, path, size in query.yield_per(_YIELD_PER):
+            yield Change(type='COPY', source=path, target=_relocate(path, source, dst), source_id=folder_id,
+                         target_id=None, size=size or 0)
 
-            elif file.hash == dst_file.hash:
-                pass
-            else:
-                if file.mtime > dst_file.mtime:
-                    change = Change(type='REPLACE', source=file, target=dst_file)
+    @staticmethod
+    def _new_files(source, dst, session):
+        """
+        @return: COPY or LCOPY changes for source files missing in an existing dst folder,
+                 LCOPY if a file with the same hash already exists on the target host
+        """
+        src_file, src_parent, dst_parent = aliased(File), aliased(Folder), aliased(Folder)
+        dst_file, dst_request = aliased(File), aliased(HashRequest)
+        # noinspection PyComparisonWithNone,PyPep8
+        query = session.query(src_file.id, src_file.path, src_file.size, src_file.hash, src_file.algorithm) \
+            .join(src_parent, src_file.folder_id == src_parent.id) \
+            .join(dst_parent, _counterpart(dst_parent, dst, src_parent, source)) \
+            .outerjoin(dst_file, _counterpart(dst_file, dst, src_file, source)) \
+            .outerjoin(dst_request, _counterpart(dst_request, dst, src_file, source)) \
+            .filter(and_(_in_tree(src_file, source), dst_file.id == None, dst_request.id == None)) \
+            .order_by(src_file.path)
+        for batch in _batches(query.yield_per(_YIELD_PER), _YIELD_PER):
+            local_files = _local_files(((row[0], row[4], row[3]) for row in batch), dst.host_id, session)
+            unmatched = [row[0] for row in batch if row[0] not in local_files]
+            if unmatched:
+                # the additional Digests of the source files may match files hashed with another algorithm
+                digests = Digest.by_files(unmatched, session)
+                local_files.update(_local_files(((file_id, algorithm, digest) for file_id, pairs in digests.items()
+                                                 for algorithm, digest in pairs), dst.host_id, session))
+            for file_id, path, size, fhash, algorithm in batch:
+                target = _relocate(path, source, dst)
+                if file_id not in local_files:
+                    yield Change(type='COPY', source=path, target=target, source_id=file_id, target_id=None,
+                                 size=size)
                 else:
-                    change = Change(type='CONFLICT', source=file, target=dst_file)
-                logger.info('Adding change: %s' % str(change))
-                changes.append(change)
-
-        for folder in source.folders:
-            dst_folder = dst.child_by_name(folder.name, session)
-            if dst_folder is None:
-                dst_folder = Folder(name=folder.name, parent=dst, host=dst.host)
-                changes.append(Change(type='COPY', source=folder, target=dst_folder))
-            else:
-                changes += ChangeSet._get_changes(source=folder, dst=dst_folder, session=session)
-
-        for file in dst.files:
-            src_file = source.child_by_name(file.name, session)
-            if src_file is None:
-                change = Change(type='DELETE', source='', target=file)
-                logger.info('Adding change: %s' % str(change))
-                changes.append(change)
+                    local_file_id, local_path = local_files[file_id]
+                    yield Change(type='LCOPY', source=local_path, target=target, source_id=local_file_id,
+                                 target_id=None, size=size)
 
-        for folder in dst.folders:
-            src_folder = source.child_by_name(folder.name, session)
-            if src_folder is None:
-                change = Change(type='DELETE', source='', target=folder)
-                logger.info('Adding change: %s' % str(change))
-                changes.append(change)
+    @staticmethod
+    def _changed_files(source, dst, session):
+        """
+        @return: REPLACE changes for files with a different hash in dst, CONFLICT if the dst file is newer,
+                 DELTA instead of REPLACE if the Blocks of both files show that only parts of it changed,
+                 files hashed with different algorithms are compared by their additional Digests
+        """
+        src_file, dst_file = aliased(File), aliased(File)
+        same = or_(and_(src_file.algorithm == dst_file.algorithm, src_file.hash == dst_file.hash),
+                   _has_digest(dst_file, src_file, session), _has_digest(src_file, dst_file, session))
+        query = session.query(src_file.id, src_file.path, src_file.size, src_file.mtime, dst_file.id, dst_file.path,
+                              dst_file.mtime) \
+            .join(dst_file, _counterpart(dst_file, dst, src_file, source)) \
+            .filter(and_(_in_tree(src_file, source), not_(same))).order_by(src_file.path)
+        for batch in _batches(query.yield_per(_YIELD_PER), _YIELD_PER):
+            blocks = Block.by_files([row[0] for row in batch] + [row[4] for row in batch], session)
+            for file_id, path, size, mtime, target_id, target, target_mtime in batch:
+                change_type = 'REPLACE' if mtime > target_mtime else 'CONFLICT'
+                if change_type == 'REPLACE' and file_id in blocks and target_id in blocks:
+                    delta_size = sum(block_size for _, block_size in
+                                     Block.delta(blocks[file_id], blocks[target_id]))
+                    if delta_size < size:
+                        change_type, size = 'DELTA', delta_size
+                yield Change(type=change_type, source=path, target=target, source_id=file_id, target_id=target_id,
+                             size=size)
 
-        return changes
+    @staticmethod
+    def _deleted(cls, dst, source, session):
+        """
+        @param cls: File or Folder
+        @return: DELETE changes for the topmost objects of type cls in dst without counterpart in source
+        """
+        dst_obj, dst_parent, src_parent = aliased(cls), aliased(Folder), aliased(Folder)
+        parent_id = dst_obj.folder_id if cls is File else dst_obj.parent_id
+        query = session.query(dst_obj.id, dst_obj.path).join(dst_parent, parent_id == dst_parent.id) \
+            .join(src_parent, _counterpart(src_parent, source, dst_parent, dst))
+        conditions = [_in_tree(dst_obj, dst)]
+        for counterpart_cls in ((File, HashRequest) if cls is File else (Folder, )):
+            src_obj = aliased(counterpart_cls)
+            query = query.outerjoin(src_obj, _counterpart(src_obj, source, dst_obj, dst))
+            # noinspection PyComparisonWithNone,PyPep8
+            conditions.append(src_obj.id == None)
+        query = query.filter(and_(*conditions)).order_by(dst_obj.path)
+        for obj_id, path in query.yield_per(_YIELD_PER):
+            yield Change(type='DELETE', source='', target=path, source_id=None, target_id=obj_id, size=0)
+
+    def delta(self, change):
+        """
+        @param change: a DELTA Change
+        @return: sorted list of (offset, size) of the source blocks that have to be written to the target
+        """
+        blocks = Block.by_files([change.source_id, change.target_id], self.session)
+        return Block.delta(blocks.get(change.source_id, dict()), blocks.get(change.target_id, dict()))
 
-    def get_string(self, fmt: str):
+    def get_lines(self, fmt: str):
         """
         @param fmt: a String containing <SOURCE>, <TARGET> and <TYPE>
-        @return a String containing all changes in the specified format
+        @return a generator yielding every change in the specified format
         """
-        output = str()
         for change in self:
             buffer = fmt
             buffer = buffer.replace('<SOURCE>', change.source)
             buffer = buffer.replace('<TARGET>', change.target)
             buffer = buffer.replace('<TYPE>', change.type)
-            output += (buffer + '\n')
-        return output
+            yield buffer
+
+    def get_string(self, fmt: str):
+        """
+        @param fmt: a String containing <SOURCE>, <TARGET> and <TYPE>
+        @return a String containing all changes in the specified format
+        """
+        return ''.join(line + '\n' for line in self.get_lines(fmt))
 
     def get_size(self):
         """
@@ -111,11 +200,121 @@ class ChangeSet(Sequence):
         """
         size = 0
         for change in self:
-            if change.type in ('COPY', 'CONFLICT', 'REPLACE'):
-                size += change.source.size
+            if change.type in ('COPY', 'CONFLICT', 'REPLACE', 'DELTA'):
+                size += change.size
         return size
 
 
+class ChangeSet(ChangeStream, Sequence):
+    """
+    This is a list of changes that need to be made in order to sync to folders
+    @param source: the source folder
+    @param dst: the target folder
+    @param session: The Session used for Querying
+    """
+
+    def __init__(self, source, dst, session):
+        super().__init__(source, dst, session)
+        self.changes = list(self._get_changes(source, dst, session))
+
+    def __len__(self):
+        return self.changes.__len__()
+
+    def __getitem__(self, index):
+        return self.changes.__getitem__(index)
+
+    def __iter__(self):
+        return iter(self.changes)
+
+
+def _batches(iterable, size):
+    """
+    @param iterable: any iterable
+    @param size: the maximum size of a batch
+    @return: generator yielding lists of up to size items
+    """
+    batch = list()
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def _local_files(digests, host_id, session):
+    """
+    @param digests: iterable of (file_id, algorithm, hash)
+    @param host_id: id of the host the copies are looked for on
+    @param session: The Session used for Querying
+    @return: dict file_id -> (id, path) of a File on the host sharing one of the digests of the file
+    """
+    by_algorithm = defaultdict(list)
+    for file_id, algorithm, digest in digests:
+        by_algorithm[algorithm].append((file_id, digest))
+    result = dict()
+    for algorithm, pairs in by_algorithm.items():
+        local_files = File.by_hashes((digest for _, digest in pairs), host_id, session, algorithm)
+        for file_id, digest in pairs:
+            if digest in local_files and file_id not in result:
+                result[file_id] = local_files[digest]
+    return result
+
+
+def _relocate(path, root, new_root):
+    """
+    @param path: a path below root
+    @param root: a Folder
+    @param new_root: a Folder
+    @return: the path at the same position below new_root
+    """
+    return '%s%s' % (new_root.path, path[len(root.path):])
+
+
+def _counterpart(obj, root, other, other_root):
+    """
+    @param obj: an (aliased) Folder, File or HashRequest below root
+    @param root: a Folder
+    @param other: an (aliased) Folder, File or HashRequest below other_root
+    @param other_root: a Folder
+    @return: the join condition matching obj with other at the same relative position
+    """
+    relocated = literal(root.path, Unicode) + func.substr(other.path, len(other_root.path) + 1)
+    return and_(obj.host_id == root.host_id, obj.path == relocated)
+
+
+def _has_digest(file, other, session):
+    """
+    @param file: an (aliased) File
+    @param other: an (aliased) File
+    @param session: The Session used for Querying
+    @return: the condition that file has an additional Digest equal to the hash of other
+    """
+    return session.query(Digest.id).filter(and_(Digest.file_id == file.id, Digest.algorithm == other.algorithm,
+                                                Digest.hash == other.hash)).exists()
+
+
+def _below(obj, folder):
+    """
+    @param obj: an (aliased) Folder, File or HashRequest
+    @param folder: an (aliased) Folder
+    @return: the condition selecting everything below folder, a range of paths the (host_id, path) indexes serve,
+             it compares the path prefix literally unlike LIKE
+    """
+    return and_(obj.host_id == folder.host_id, obj.path >= folder.path,
+                obj.path < folder.path.concat(literal(_MAX_CHAR, Unicode)))
+
+
+def _in_tree(obj, root):
+    """
+    @param obj: an (aliased) Folder, File or HashRequest
+    @param root: a Folder
+    @return: the condition selecting everything below root, root excluded
+    """
+    return and_(obj.host_id == root.host_id, obj.path.startswith(root.path, autoescape=True), obj.path != root.path)
+
+
 def main(args=sys.argv[1:]):
     """
     main :)
@@ -127,6 +326,7 @@ def main(args=sys.argv[1:]):
     parser.add_argument('--source', type=str, metavar='URI', required=True)
     parser.add_argument('--dst', type=str, metavar='URI', required=True)
     parser.add_argument('--format', type=str, metavar='FORMAT', default='<SOURCE>::<TYPE>::<TARGET>')
+    parser.add_argument('--list', action='store_true', help='Print every change in FORMAT')
 
     args = parser.parse_args(args)
 
@@ -152,7 +352,10 @@ def main(args=sys.argv[1:]):
         dst = Folder.by_uri(args.dst, session)
         logger.info('Target: %s', dst)
 
-        changes = ChangeSet(source=source, dst=dst, session=session)
+        changes = ChangeStream(source=source, dst=dst, session=session)
+        if args.list:
+            for line in changes.get_lines(args.format):
+                print(line)
         print('%sGB' % (changes.get_size() / 2 ** 30))
 
     except Exception as e:
@@ -2,11 +2,36 @@
 """
 My unittest
 """
+import asyncio
+from hashlib import md5, blake2b
 import logging
 import os
+from queue import Queue, Empty, Full
+import socket
+from threading import Thread, Event
 from tempfile import mkdtemp
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.pool import QueuePool
+
+import base
+from base import Base, Region, Host, Folder, File, HashRequest, Server, Digest, Block, PATH_INDEX
+import config
 import configurator
+import database
+import devices
+import hasher
+import protocol
+import scanner
+import server
+import sync
+import watcher
 
 
 __author__ = 'konsti'
@@ -65,5 +90,938 @@ class ConfiguratorTest(unittest.TestCase):
             pass
 
 
+class DatabaseTest(unittest.TestCase):
+    def setUp(self):
+        database.DATABASE_STRING = 'sqlite:///%s/unittest.db' % mkdtemp()
+        database.dispose()
+
+    def test_thread_session(self):
+        session = database.get_thread_session()
+        session.close()
+        self.assertIs(database.get_thread_session(), session)
+        sessions = list()
+        thread = Thread(target=lambda: sessions.append(database.get_thread_session()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], session)
+
+    def test_replaced_database(self):
+        session = database.get_thread_session()
+        database._DATABASE = create_engine(database.DATABASE_STRING, echo=False)
+        self.assertIs(database.get_session().bind, database._DATABASE)
+        self.assertIs(database.get_thread_session().bind, database._DATABASE)
+        self.assertIsNot(database.get_thread_session(), session)
+
+    def test_reserve(self):
+        self.assertEqual(database.reserve(40), 40)
+        self.assertEqual(database.reserve(16), 16)
+        self.assertEqual(database.pool_size(), 56)
+
+    def test_reserve_existing_pool(self):
+        database._DATABASE = create_engine(database.DATABASE_STRING, poolclass=QueuePool, pool_size=5,
+                                           max_overflow=3)
+        self.assertEqual(database.reserve(6), 6)
+        self.assertEqual(database.reserve(32), 2)
+        self.assertEqual(database.reserve(32), 1)
+
+    def test_pre_ping(self):
+        self.assertTrue(database.get_database().pool._pre_ping)
+
+    def tearDown(self):
+        database.dispose()
+
+
+class ConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.cs = 'sqlite:///%s/unittest.db' % self.directory
+        engine = create_engine(self.cs, echo=False)
+        Base.metadata.create_all(engine)
+        engine.dispose()
+        self.configfile = os.path.join(self.directory, 'configfile.xml')
+        with open(self.configfile, 'w') as file:
+            file.write('<?xml version="1.0"?>\n'
+                       '<Host hostname="config-host" region="Home" database="%s">\n'
+                       '    <hasher processes="3" remote_digest="true" block_size="65536"/>\n'
+                       '    <scanner interval="60" watch="true" workers="4"><folder global="/tmp/a"/></scanner>\n'
+                       '    <scanner><folder global="/mnt/b" local="/tmp/b"/></scanner>\n'
+                       '    <server><folder global="/tmp/a"/></server>\n'
+                       '</Host>\n' % self.cs)
+
+    def test_parse(self):
+        host_config = config.parse(self.configfile)
+        self.assertEqual(host_config.hostname, 'config-host')
+        self.assertEqual(host_config.region, 'Home')
+        self.assertEqual(host_config.database, self.cs)
+        self.assertEqual(host_config.hasher_processes, 3)
+        self.assertTrue(host_config.remote_digest)
+        self.assertEqual(host_config.block_size, 65536)
+        self.assertEqual(host_config.scanners, [config.ScannerConfig('/tmp/a', 60, True, 4),
+                                                config.ScannerConfig('/tmp/b', config.SCANNER_INTERVAL, False, None)])
+        self.assertEqual(host_config.servers, ['/tmp/a'])
+
+    def test_roles(self):
+        roles = config.get_roles(config.parse(self.configfile))
+        self.assertEqual([role.name for role in roles], ['hasher', 'scanner:/tmp/a', 'scanner:/tmp/b', 'server'])
+        self.assertEqual(roles[0].target.keywords, {'remote_digest': True, 'hostname': 'config-host',
+                                                    'block_size': 65536})
+        self.assertEqual(roles[3].target.args[0][-4:], ['--name', 'config-host', '--block-size', '65536'])
+        self.assertEqual(roles[1].target.args, ('/tmp/a', 60))
+        self.assertEqual(roles[1].target.keywords, {'watch': True, 'workers': 4})
+
+    def test_register_roots(self):
+        host_config = config.parse(self.configfile)
+        config.register_roots(host_config, self.cs)
+        # a second start must not add the roots again
+        config.register_roots(host_config, self.cs)
+        engine = create_engine(self.cs, echo=False)
+        session = sessionmaker(bind=engine)()
+        try:
+            host = Host.by_name('config-host', session)
+            self.assertEqual(host.region.name, 'home')
+            self.assertEqual(sorted(root.path for root in host.roots), ['/tmp/a/', '/tmp/b/'])
+        finally:
+            session.close()
+            engine.dispose()
+
+
+class ScannerTest(unittest.TestCase):
+    def setUp(self):
+        self.root = mkdtemp()
+        self.tempfile = '%s/unittest.db' % mkdtemp()
+        database.DATABASE_STRING = 'sqlite:///%s' % self.tempfile
+        database._DATABASE = create_engine(database.DATABASE_STRING, echo=False)
+        PATH_INDEX.clear()
+        args = ['--database', database.DATABASE_STRING, '--create_schema', '--name', config.HOSTNAME,
+                '--add', self.root]
+        configurator.main(args=args)
+        self.queue = Queue()
+        self.worker = scanner.Worker.__new__(scanner.Worker)
+        self.worker._queue = self.queue
+        self.worker._buffer = scanner.RequestBuffer()
+
+    def scan(self, full=True):
+        self.queue.put(self.item(self.root, full))
+        while not self.queue.empty():
+            self.worker._scan(self.queue.get())
+        self.worker._buffer.flush()
+
+    @staticmethod
+    def item(path, full=True):
+        return scanner.ScanItem(scanner.Path(path), os.stat(path), full, True)
+
+    def children(self, cls):
+        session = database.get_session()
+        try:
+            return sorted(obj.name for obj in session.query(cls))
+        finally:
+            session.close()
+
+    def test_scan_new_tree(self):
+        os.mkdir(os.path.join(self.root, 'sub'))
+        open(os.path.join(self.root, 'a'), 'w').close()
+        open(os.path.join(self.root, 'sub', 'b'), 'w').close()
+        self.scan()
+        self.assertEqual(self.children(HashRequest), ['a', 'b'])
+        self.assertEqual(len(self.children(Folder)), 2)
+
+    def test_buffered_requests(self):
+        for name in 'abc':
+            open(os.path.join(self.root, name), 'w').close()
+        self.worker._buffer.size = 2
+        self.worker._scan(self.item(self.root))
+        self.assertEqual(len(self.worker._buffer), 0)
+        self.assertEqual(self.children(HashRequest), ['a', 'b', 'c'])
+
+    def test_stat_passed_along(self):
+        os.mkdir(os.path.join(self.root, 'sub'))
+        os.symlink(os.path.join(self.root, 'missing'), os.path.join(self.root, 'dangling'))
+        self.worker._scan(self.item(self.root))
+        item = self.queue.get()
+        self.assertEqual(item.path, scanner.Path(self.root, 'sub'))
+        self.assertEqual(item.stat.st_ino, os.stat(os.path.join(self.root, 'sub')).st_ino)
+        self.assertTrue(self.queue.empty())
+        self.assertEqual(self.children(HashRequest), [])
+
+    def test_incremental_scan(self):
+        os.mkdir(os.path.join(self.root, 'sub'))
+        open(os.path.join(self.root, 'a'), 'w').close()
+        self.scan()
+        with open(os.path.join(self.root, 'a'), 'w') as file:
+            file.write('modified in place')
+        open(os.path.join(self.root, 'sub', 'b'), 'w').close()
+        session = database.get_session()
+        try:
+            session.query(HashRequest).delete()
+            session.commit()
+        finally:
+            session.close()
+        self.scan(full=False)
+        self.assertEqual(self.children(HashRequest), ['b'])
+        self.scan(full=True)
+        self.assertEqual(self.children(HashRequest), ['a', 'b'])
+
+    def test_lost_requests(self):
+        open(os.path.join(self.root, 'a'), 'w').close()
+        self.worker._scan(self.item(self.root))
+        # the process died before the buffer was flushed
+        self.worker._buffer = scanner.RequestBuffer()
+        self.scan(full=False)
+        self.assertEqual(self.children(HashRequest), ['a'])
+        session = database.get_session()
+        try:
+            root = Folder.by_uri('%s::%s' % (config.HOSTNAME, self.root), session)
+            self.assertEqual(root.mtime, datetime.fromtimestamp(os.stat(self.root).st_mtime))
+        finally:
+            session.close()
+
+    def test_reported_twice_before_flush(self):
+        open(os.path.join(self.root, 'a'), 'w').close()
+        self.worker._scan(self.item(self.root))
+        open(os.path.join(self.root, 'b'), 'w').close()
+        reported = scanner.ScanItem(scanner.Path(self.root), os.stat(self.root), True, False)
+        self.worker._scan(reported)
+        self.worker._scan(reported)
+        self.assertEqual(len(self.worker._buffer), 2)
+        self.worker._buffer.flush()
+        self.assertEqual(self.children(HashRequest), ['a', 'b'])
+        self.assertEqual(self.worker._buffer.pending(1), set())
+
+    def test_deleted_before_flush(self):
+        os.mkdir(os.path.join(self.root, 'sub'))
+        os.mkdir(os.path.join(self.root, 'gone'))
+        open(os.path.join(self.root, 'a'), 'w').close()
+        open(os.path.join(self.root, 'sub', 'b'), 'w').close()
+        open(os.path.join(self.root, 'gone', 'c'), 'w').close()
+        self.queue.put(self.item(self.root))
+        while not self.queue.empty():
+            self.worker._scan(self.queue.get())
+        session = database.get_session()
+        try:
+            # removed behind the back of the buffer
+            sub = Folder.by_uri('%s::%s' % (config.HOSTNAME, os.path.join(self.root, 'sub')), session)
+            session.query(Folder).filter(Folder.id == sub.id).delete(synchronize_session=False)
+            gone = Folder.by_uri('%s::%s' % (config.HOSTNAME, os.path.join(self.root, 'gone')), session)
+            Folder.delete_by_ids([gone.id], session)
+            session.commit()
+        finally:
+            session.close()
+        self.assertEqual(len(self.worker._buffer), 2)
+        self.worker._buffer.flush()
+        self.assertEqual(self.children(HashRequest), ['a'])
+
+    def test_failed_flush(self):
+        os.mkdir(os.path.join(self.root, 'sub'))
+        open(os.path.join(self.root, 'sub', 'b'), 'w').close()
+        self.scan()
+        lost = list()
+        buffer = scanner.RequestBuffer(on_lost=lost.extend)
+        session = database.get_session()
+        try:
+            request = session.query(HashRequest).one()
+            mapping = dict(name=request.name, path=request.path, mtime=request.mtime, size=None,
+                           host_id=request.host_id, folder_id=request.folder_id, locked=False)
+        finally:
+            session.close()
+        buffer.add_all([mapping], mapping['folder_id'], mapping['mtime'])
+        buffer.flush()
+        self.assertEqual(lost, [os.path.join(self.root, 'sub')])
+        self.assertEqual(buffer.pending(mapping['folder_id']), set())
+
+    def test_reported_folder(self):
+        os.mkdir(os.path.join(self.root, 'sub'))
+        self.scan()
+        open(os.path.join(self.root, 'a'), 'w').close()
+        os.mkdir(os.path.join(self.root, 'new'))
+        self.worker._scan(scanner.ScanItem(scanner.Path(self.root), os.stat(self.root), True, False))
+        self.assertEqual([item.path for item in self.queue.queue], [scanner.Path(self.root, 'new')])
+        self.worker._buffer.flush()
+        self.assertEqual(self.children(HashRequest), ['a'])
+
+    def test_scan_queue_order(self):
+        queue = scanner.ScanQueue(maxsize=4)
+        stat = os.stat(self.root)
+        old = os.stat_result(stat[:8] + (0, 0))
+        for path in ('/b', '/a/z', '/c', '/a'):
+            queue.put_nowait(scanner.ScanItem(scanner.Path(path), stat if path == '/c' else old, True, True))
+        self.assertRaises(Full, queue.put_nowait, scanner.ScanItem(scanner.Path('/d'), old, True, True))
+        self.assertEqual([str(queue.get().path) for _ in range(4)], ['/c', '/a', '/a/z', '/b'])
+
+    def test_full_queue(self):
+        os.makedirs(os.path.join(self.root, 'a', 'b'))
+        os.mkdir(os.path.join(self.root, 'c'))
+        self.queue = self.worker._queue = scanner.ScanQueue(maxsize=1)
+        overflow = self.worker._scan(self.item(self.root))
+        self.assertEqual(len(overflow), 1)
+        self.assertEqual({overflow[0].path, self.queue.get().path},
+                         {scanner.Path(self.root, 'a'), scanner.Path(self.root, 'c')})
+
+    def test_device_queues(self):
+        os.makedirs(os.path.join(self.root, 'sub', 'deep'))
+        open(os.path.join(self.root, 'sub', 'deep', 'a'), 'w').close()
+        queues = scanner.DeviceQueues(self.worker._buffer, workers=2)
+        queues.put(self.item(self.root))
+        queues.join()
+        self.assertTrue(queues.empty())
+        self.worker._buffer.flush()
+        self.assertEqual(self.children(HashRequest), ['a'])
+
+    def test_device_probe_unlocked(self):
+        probing, probed = Event(), Event()
+        scan_workers = devices.scan_workers
+
+        def slow_scan_workers(path, st_dev):
+            probing.set()
+            probed.wait(10)
+            return 1
+
+        devices.scan_workers = slow_scan_workers
+        try:
+            queues = scanner.DeviceQueues(self.worker._buffer)
+            putter = Thread(target=queues.put, args=(self.item(self.root), ))
+            putter.start()
+            self.assertTrue(probing.wait(10))
+            checker = Thread(target=queues.empty)
+            checker.start()
+            checker.join(5)
+            self.assertFalse(checker.is_alive())
+            probed.set()
+            putter.join(10)
+            queues.join()
+        finally:
+            probed.set()
+            devices.scan_workers = scan_workers
+
+    def test_rescan_removes_vanished(self):
+        os.mkdir(os.path.join(self.root, 'sub'))
+        open(os.path.join(self.root, 'sub', 'b'), 'w').close()
+        open(os.path.join(self.root, 'a'), 'w').close()
+        self.scan()
+        os.remove(os.path.join(self.root, 'sub', 'b'))
+        os.rmdir(os.path.join(self.root, 'sub'))
+        self.scan()
+        self.assertEqual(self.children(HashRequest), ['a'])
+        self.assertEqual(len(self.children(Folder)), 1)
+        self.assertIsNone(PATH_INDEX.get(1, os.path.join(self.root, 'sub')))
+
+    def test_remove_large_tree(self):
+        for sub in 'abcde':
+            os.makedirs(os.path.join(self.root, 'tree', sub, 'deep'))
+            for name in 'xyz':
+                open(os.path.join(self.root, 'tree', sub, name), 'w').close()
+        open(os.path.join(self.root, 'kept'), 'w').close()
+        self.scan()
+        for sub in 'abcde':
+            for name in 'xyz':
+                os.remove(os.path.join(self.root, 'tree', sub, name))
+            os.removedirs(os.path.join(self.root, 'tree', sub, 'deep'))
+        in_chunk, base._IN_CHUNK = base._IN_CHUNK, 2
+        try:
+            self.scan()
+        finally:
+            base._IN_CHUNK = in_chunk
+        self.assertEqual(self.children(HashRequest), ['kept'])
+        self.assertEqual(len(self.children(Folder)), 1)
+
+    def test_path_index(self):
+        os.makedirs(os.path.join(self.root, 'sub', 'deep'))
+        self.scan()
+        path = os.path.join(self.root, 'sub', 'deep')
+        session = database.get_session()
+        try:
+            folder = Folder.by_uri('%s::%s' % (config.HOSTNAME, path), session)
+            self.assertEqual(PATH_INDEX.get(folder.host_id, path), folder.id)
+            PATH_INDEX.clear()
+            self.assertEqual(Folder.by_uri('%s::%s' % (config.HOSTNAME, path), session), folder)
+            self.assertEqual(PATH_INDEX.get(folder.host_id, path), folder.id)
+        finally:
+            session.close()
+
+    def test_path_index_rollback(self):
+        session = database.get_session()
+        try:
+            root = Folder.by_uri('%s::%s' % (config.HOSTNAME, self.root), session)
+            session.add(root.add_folder('sub'))
+            session.flush()
+            path = os.path.join(self.root, 'sub')
+            folder = root.host.descendant_by_path(path, session)
+            self.assertEqual(PATH_INDEX.get(root.host_id, path), folder.id)
+            session.rollback()
+            self.assertIsNone(PATH_INDEX.get(root.host_id, path))
+            self.assertIsNotNone(PATH_INDEX.get(root.host_id, self.root))
+            session.add(root.add_folder('sub'))
+            session.flush()
+            folder = root.host.descendant_by_path(path, session)
+            session.commit()
+            self.assertEqual(PATH_INDEX.get(root.host_id, path), folder.id)
+        finally:
+            session.close()
+
+    def test_rescan_detects_modification(self):
+        path = os.path.join(self.root, 'a')
+        open(path, 'w').close()
+        self.scan()
+        session = database.get_session()
+        request = session.query(HashRequest).one()
+        session.add(File(name=request.name, folder_id=request.folder_id, host_id=request.host_id, hash='x',
+                         mtime=request.mtime, size=request.size))
+        session.delete(request)
+        session.commit()
+        session.close()
+        self.scan()
+        self.assertEqual(self.children(HashRequest), [])
+        with open(path, 'w') as file:
+            file.write('changed')
+        self.scan()
+        self.assertEqual(self.children(HashRequest), ['a'])
+        self.assertEqual(self.children(File), [])
+
+    def test_file_uri(self):
+        open(os.path.join(self.root, 'a'), 'w').close()
+        self.scan()
+        session = database.get_session()
+        try:
+            request = session.query(HashRequest).one()
+            file = File(name=request.name, folder_id=request.folder_id, host_id=request.host_id, hash='x',
+                        mtime=request.mtime, size=request.size)
+            session.add(file)
+            session.delete(request)
+            session.commit()
+            self.assertEqual(file.uri, '%s::%s' % (config.HOSTNAME, os.path.join(self.root, 'a')))
+            self.assertEqual(File.by_uri(file.uri, session), file)
+        finally:
+            session.close()
+
+    def test_children_by_name(self):
+        os.mkdir(os.path.join(self.root, 'sub'))
+        open(os.path.join(self.root, 'a'), 'w').close()
+        self.scan()
+        session = database.get_session()
+        try:
+            root = Folder.by_uri('%s::%s' % (config.HOSTNAME, self.root), session)
+            children = root.children_by_name(['a', 'sub', 'missing'], session)
+            self.assertEqual(sorted(children), ['a', 'sub'])
+            self.assertIsInstance(children['a'], HashRequest)
+            self.assertIsInstance(children['sub'], Folder)
+            self.assertEqual(root.child_by_name('sub', session), children['sub'])
+            self.assertIsNone(root.child_by_name('missing', session))
+        finally:
+            session.close()
+
+    def test_materialized_path(self):
+        os.makedirs(os.path.join(self.root, 'sub', 'deep'))
+        open(os.path.join(self.root, 'sub', 'deep', 'a'), 'w').close()
+        self.scan()
+        session = database.get_session()
+        try:
+            request = Folder.by_uri('%s::%s' % (config.HOSTNAME, os.path.join(self.root, 'sub', 'deep', 'a')), session)
+            self.assertEqual(request.path, os.path.join(self.root, 'sub', 'deep', 'a'))
+            sub = Folder.by_uri('%s::%s' % (config.HOSTNAME, os.path.join(self.root, 'sub')), session)
+            root = sub.parent
+            sub.move(root, 'moved', session)
+            session.commit()
+            self.assertEqual(request.folder.path, os.path.join(self.root, 'moved', 'deep', ''))
+            self.assertEqual(session.query(HashRequest).one().path, os.path.join(self.root, 'moved', 'deep', 'a'))
+            self.assertIsNone(PATH_INDEX.get(root.host_id, os.path.join(self.root, 'sub')))
+        finally:
+            session.close()
+
+    def tearDown(self):
+        database._DATABASE = None
+        try:
+            os.remove(self.tempfile)
+        except FileNotFoundError:
+            pass
+
+
+@unittest.skipUnless(watcher.available(), 'inotify is not available')
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.root = mkdtemp()
+        os.mkdir(os.path.join(self.root, 'sub'))
+        self.changed = Queue()
+        self.watcher = watcher.Watcher(self.root, self.changed.put, delay=0.1, max_delay=1)
+        self.assertTrue(self.watcher.start())
+
+    def test_coalesce(self):
+        for name in 'abc':
+            open(os.path.join(self.root, 'sub', name), 'w').close()
+        self.assertEqual(self.changed.get(timeout=5), os.path.join(self.root, 'sub'))
+        self.assertRaises(Empty, self.changed.get, timeout=0.5)
+
+    def test_new_directory(self):
+        os.mkdir(os.path.join(self.root, 'new'))
+        self.assertEqual(self.changed.get(timeout=5), self.root)
+        with open(os.path.join(self.root, 'new', 'a'), 'w') as file:
+            file.write('a')
+        self.assertEqual(self.changed.get(timeout=5), os.path.join(self.root, 'new'))
+
+    def tearDown(self):
+        self.watcher.stop()
+
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        PATH_INDEX.clear()
+        self.session = sessionmaker(bind=create_engine('sqlite://', echo=False))()
+        Base.metadata.create_all(self.session.bind)
+        self.now = datetime.now()
+        self.source = self.root('src', '/src/')
+        self.dst = self.root('dst', '/dst/')
+        self.file(self.source, 'x', '1')
+        self.file(self.source, 'y', '2', self.now)
+        self.file(self.source.add_folder('sub'), 'z', '3')
+        self.file(self.dst, 'y', '4')
+        self.file(self.dst, 'w', '5')
+        self.file(self.dst.add_folder('old'), 'q', '6')
+        self.file(self.root('dst', '/other/'), 'copy_of_x', '1')
+        self.session.commit()
+
+    def root(self, hostname, path):
+        try:
+            host = Host.by_name(hostname, self.session)
+        except NoResultFound:
+            host = Host.create_new(hostname, None)
+        root = host.add_root(path, self.session)
+        self.session.add(root)
+        return root
+
+    def file(self, folder, name, fhash, mtime=datetime(2000, 1, 1), algorithm='md5'):
+        file = folder.add_file(name, fhash, mtime, 1, algorithm)
+        self.session.add(file)
+        return file
+
+    def test_changes(self):
+        changes = sync.ChangeSet(self.source, self.dst, self.session)
+        result = sorted((change.type, change.target) for change in changes)
+        self.assertEqual(result, [('COPY', '/dst/sub/'), ('DELETE', '/dst/old/'), ('DELETE', '/dst/w'),
+                                  ('LCOPY', '/dst/x'), ('REPLACE', '/dst/y')])
+        lcopy = [change for change in changes if change.type == 'LCOPY'][0]
+        self.assertEqual(lcopy.source, '/other/copy_of_x')
+        self.assertEqual(changes.get_size(), 2)
+
+    def test_streaming(self):
+        changes = sync.ChangeStream(self.source, self.dst, self.session)
+        self.assertNotIsInstance(changes, Sequence)
+        self.assertRaises(TypeError, len, changes)
+        self.assertEqual(sorted(changes.get_lines('<TYPE> <TARGET>')),
+                         ['COPY /dst/sub/', 'DELETE /dst/old/', 'DELETE /dst/w', 'LCOPY /dst/x', 'REPLACE /dst/y'])
+        self.assertEqual(changes.get_size(), 2)
+
+    def test_folder_size(self):
+        deep = self.source.add_folder('sub_deep').add_folder('deep')
+        self.file(deep, 'a', '7').size = 5
+        self.file(self.source.add_folder('subxdeep'), 'b', '8').size = 7
+        self.source.add_folder('empty')
+        wide = self.source.add_folder('wide')
+        self.file(wide, '\U0001f600', '9').size = 11
+        self.file(wide.add_folder('\uffff'), 'c', '10').size = 13
+        self.file(self.source.add_folder('wide0'), 'd', '11').size = 17
+        self.session.commit()
+        sizes = dict((change.target, change.size) for change in sync.ChangeSet(self.source, self.dst, self.session)
+                     if change.type == 'COPY')
+        self.assertEqual(sizes, {'/dst/sub/': 1, '/dst/sub_deep/': 5, '/dst/subxdeep/': 7, '/dst/empty/': 0,
+                                 '/dst/wide/': 24, '/dst/wide0/': 17})
+
+    def test_by_hashes(self):
+        local_files = File.by_hashes(['1', '2', '9'], self.dst.host_id, self.session)
+        self.assertEqual(sorted(local_files), ['1'])
+        self.assertEqual(local_files['1'][1], '/other/copy_of_x')
+
+    def test_migrated_hash(self):
+        self.file(self.source, 'm', 'new', algorithm='blake2b')
+        self.file(self.dst, 'm', 'old').digests = [Digest(algorithm='blake2b', hash='new')]
+        self.file(self.source, 'n', 'new', algorithm='blake2b')
+        self.file(self.dst, 'n', 'new')
+        self.session.commit()
+        targets = [change.target for change in sync.ChangeSet(self.source, self.dst, self.session)]
+        self.assertNotIn('/dst/m', targets)
+        self.assertIn('/dst/n', targets)
+
+    def test_lcopy_by_digest(self):
+        self.file(self.source, 'p', 'p-blake2b', algorithm='blake2b').digests = [Digest(algorithm='md5', hash='p-md5')]
+        self.file(self.root('dst', '/copies/'), 'copy_of_p', 'p-md5')
+        self.file(self.source, 'r', 'r-md5')
+        self.file(Folder.by_uri('dst::/copies/', self.session), 'copy_of_r', 'r-sha1',
+                  algorithm='sha1').digests = [Digest(algorithm='md5', hash='r-md5')]
+        self.session.commit()
+        changes = dict((change.target, change) for change in sync.ChangeSet(self.source, self.dst, self.session))
+        self.assertEqual((changes['/dst/p'].type, changes['/dst/p'].source), ('LCOPY', '/copies/copy_of_p'))
+        self.assertEqual((changes['/dst/r'].type, changes['/dst/r'].source), ('LCOPY', '/copies/copy_of_r'))
+
+    def test_delta(self):
+        large = self.file(self.source, 'large', 'new', self.now)
+        large.size = 30
+        large.blocks = [Block(offset=offset, size=10, hash=block_hash) for offset, block_hash in ((0, 'a'), (10, 'b'),
+                                                                                                   (20, 'c'))]
+        self.file(self.dst, 'large', 'old').blocks = [Block(offset=offset, size=10, hash=block_hash)
+                                                      for offset, block_hash in ((0, 'a'), (10, 'x'), (20, 'c'))]
+        self.session.commit()
+        changes = sync.ChangeSet(self.source, self.dst, self.session)
+        delta = [change for change in changes if change.target == '/dst/large'][0]
+        self.assertEqual((delta.type, delta.size), ('DELTA', 10))
+        self.assertEqual(changes.delta(delta), [(10, 10)])
+
+    def test_delta_needs_same_algorithm(self):
+        large = self.file(self.source, 'large', 'new', self.now)
+        large.size = 20
+        large.blocks = [Block(offset=offset, size=10, algorithm='md5', hash='a') for offset in (0, 10)]
+        self.file(self.dst, 'large', 'old').blocks = [Block(offset=0, size=10, algorithm='sha1', hash='a'),
+                                                      Block(offset=10, size=10, algorithm='sha1', hash='b')]
+        self.session.commit()
+        changes = sync.ChangeSet(self.source, self.dst, self.session)
+        self.assertEqual([change.type for change in changes if change.target == '/dst/large'], ['REPLACE'])
+
+    def test_no_changes(self):
+        self.assertEqual(len(sync.ChangeSet(self.source, self.source, self.session)), 0)
+
+    def tearDown(self):
+        self.session.close()
+
+
+class DevicesTest(unittest.TestCase):
+    def test_unknown_device(self):
+        device = os.makedev(0, 12345)
+        self.assertIsNone(devices.rotational(device))
+        self.assertEqual(devices.hash_limit(device, 4), 4)
+        self.assertIn(devices.scan_workers(mkdtemp(), device), (devices.SOLID_STATE_WORKERS, devices.REMOTE_WORKERS))
+
+    def test_latency_lists_once(self):
+        root = mkdtemp()
+        for name in ('a', 'b', 'c'):
+            os.makedirs(os.path.join(root, name, 'deep'))
+        open(os.path.join(root, 'file'), 'w').close()
+        listed = list()
+        scandir = os.scandir
+
+        def spy(path):
+            listed.append(path)
+            return scandir(path)
+
+        os.scandir = spy
+        try:
+            self.assertGreaterEqual(devices.latency(root, 3), 0)
+        finally:
+            os.scandir = scandir
+        self.assertEqual(len(listed), 3)
+        self.assertEqual(len(set(listed)), 3)
+        self.assertEqual(listed[0], root)
+
+
+class ClaimTest(unittest.TestCase):
+    def setUp(self):
+        self.session = sessionmaker(bind=create_engine('sqlite://', echo=False))()
+        Base.metadata.create_all(self.session.bind)
+        region = Region.create_new('region')
+        self.host = Host.create_new('host', region)
+        root = self.host.add_root('/root/', self.session)
+        for name in 'abc':
+            request = root.add_file(name, None, datetime.now(), 1)
+            self.session.add(Server(ip='localhost', port=0, request=request))
+        self.session.add(root.add_file('unserved', None, datetime.now(), 1))
+        self.session.add(Host.create_new('other', region))
+        self.session.commit()
+
+    def test_claim(self):
+        other = Host.by_name('other', self.session)
+        first = HashRequest.claim(other, 2, 60, self.session)
+        self.assertEqual(len(first), 2)
+        second = HashRequest.claim(other, 2, 60, self.session)
+        self.assertEqual(len(second), 1)
+        self.assertFalse(set(first) & set(second))
+        self.assertEqual(HashRequest.claim(other, 2, 60, self.session), [])
+
+    def test_claim_local(self):
+        claimed = HashRequest.claim(self.host, 10, 60, self.session)
+        self.assertEqual(len(claimed), 4)
+
+    def test_claim_own(self):
+        self.assertEqual(HashRequest.claim(Host.by_name('other', self.session), 10, 60, self.session, own=True), [])
+        self.assertEqual(len(HashRequest.claim(self.host, 10, 60, self.session, own=True)), 4)
+
+    def test_expired_lease(self):
+        claimed = HashRequest.claim(self.host, 3, 60, self.session)
+        self.session.query(HashRequest).update({HashRequest.locked_at: datetime.now() - timedelta(seconds=120)})
+        self.assertEqual(HashRequest.claim(self.host, 3, 60, self.session), claimed)
+
+    def tearDown(self):
+        self.session.close()
+
+
+class EngineTest(unittest.TestCase):
+    def setUp(self):
+        self.root = mkdtemp()
+        self.tempfile = '%s/unittest.db' % mkdtemp()
+        database.DATABASE_STRING = 'sqlite:///%s' % self.tempfile
+        database._DATABASE = create_engine(database.DATABASE_STRING, echo=False)
+        Base.metadata.create_all(database._DATABASE)
+        session = database.get_session()
+        root = Host.create_new(socket.gethostname(), None).add_root(self.root, session)
+        for name in 'ab':
+            with open(os.path.join(self.root, name), 'wb') as file:
+                file.write(name.encode('ascii') * 1000)
+            session.add(root.add_file(name, None, datetime.now(), 1000))
+        session.commit()
+        session.close()
+        self.loop = asyncio.new_event_loop()
+        self.engine = hasher.Engine(2, 0, loop=self.loop)
+
+    def test_work(self):
+        self.assertTrue(self.loop.run_until_complete(self.engine.work()))
+        self.assertFalse(self.loop.run_until_complete(self.engine.work()))
+        session = database.get_session()
+        try:
+            self.assertEqual(sorted((file.name, file.hash) for file in session.query(File)),
+                             [(name, md5(name.encode('ascii') * 1000).hexdigest()) for name in 'ab'])
+            self.assertEqual(session.query(HashRequest).count(), 0)
+        finally:
+            session.close()
+
+    def test_failed_store(self):
+        session = database.get_session()
+        try:
+            root = session.query(Folder).one()
+            session.add(root.add_file('c', None, datetime.now(), 1000))
+            session.commit()
+            request_ids = hasher.get_requests()
+            requests = dict((request.name, request) for request in session.query(HashRequest))
+            # listed twice before the first request was fulfilled
+            session.add(File(name='a', path=requests['a'].path, folder_id=root.id, host_id=root.host_id, hash='a',
+                             mtime=requests['a'].mtime, size=1000))
+            session.commit()
+            ids = dict((name, request.id) for name, request in requests.items())
+        finally:
+            session.close()
+        self.assertEqual(len(request_ids), 3)
+        hasher.store_hashes({ids['a']: hasher.Hashes([('md5', 'a2')]), ids['b']: hasher.Hashes([('md5', None)]),
+                             ids['c']: hasher.Hashes([('md5', 'c')])})
+        session = database.get_session()
+        try:
+            self.assertEqual(sorted((file.name, file.hash) for file in session.query(File)), [('a', 'a'), ('c', 'c')])
+            self.assertEqual([(request.name, request.locked) for request in session.query(HashRequest)],
+                             [('b', False)])
+        finally:
+            session.close()
+
+    def test_configured_hostname(self):
+        session = database.get_session()
+        Host.by_name(socket.gethostname(), session).name = 'configured'
+        session.commit()
+        session.close()
+        self.assertNotEqual(socket.gethostname(), 'configured')
+        self.engine.close()
+        self.engine = hasher.Engine(2, 0, loop=self.loop, hostname='configured')
+        self.assertTrue(self.loop.run_until_complete(self.engine.work()))
+        session = database.get_session()
+        try:
+            self.assertEqual(session.query(File).count(), 2)
+            self.assertEqual(session.query(HashRequest).count(), 0)
+        finally:
+            session.close()
+
+    def test_unregistered_server_host(self):
+        self.assertRaises(ValueError, server.main, ['--database', database.DATABASE_STRING, '--name', 'unknown'])
+
+    def test_remote_digest(self):
+        session_maker = sessionmaker(bind=database._DATABASE)
+        tcp_server = ServerTest.start_server(session_maker)
+        ip, port = tcp_server.server_address
+        session = session_maker()
+        region = Region.create_new('region')
+        Host.by_name(socket.gethostname(), session).region = region
+        remote = Host.create_new('remote', region).add_root(self.root, session)
+        session.add(Server(ip=ip, port=port, request=remote.add_file('a', None, datetime.now(), 1000)))
+        session.query(HashRequest).filter(HashRequest.host_id != remote.host.id).delete()
+        session.commit()
+        session.close()
+        digested = list()
+        digest_chunks = server.digest_chunks
+
+        def spy(get_path, pool=None):
+            digested.append(get_path())
+            return digest_chunks(get_path, pool)
+
+        server.digest_chunks = spy
+        # the server sends the blocks of its own block size
+        block_size, hasher.BLOCK_SIZE = hasher.BLOCK_SIZE, 400
+        try:
+            self.engine.close()
+            self.engine = hasher.Engine(2, 0, loop=self.loop, remote_digest=True)
+            self.assertTrue(self.loop.run_until_complete(self.engine.work()))
+        finally:
+            hasher.BLOCK_SIZE = block_size
+            server.digest_chunks = digest_chunks
+            tcp_server.shutdown()
+            tcp_server.server_close()
+        self.assertEqual(digested, [os.path.join(self.root, 'a')])
+        session = database.get_session()
+        try:
+            self.assertEqual([(file.name, file.hash) for file in session.query(File)],
+                             [('a', md5(b'a' * 1000).hexdigest())])
+            self.assertEqual(sorted((block.offset, block.size) for block in session.query(Block)),
+                             [(0, 400), (400, 400), (800, 200)])
+        finally:
+            session.close()
+
+    def tearDown(self):
+        self.engine.close()
+        self.loop.close()
+        os.remove(self.tempfile)
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.root = mkdtemp()
+        self.data = os.urandom(100000)
+        with open(os.path.join(self.root, 'a'), 'wb') as file:
+            file.write(self.data)
+        self.tempfile = '%s/unittest.db' % mkdtemp()
+        session_maker = sessionmaker(bind=create_engine('sqlite:///%s' % self.tempfile, echo=False))
+        Base.metadata.create_all(session_maker.kw['bind'])
+        session = session_maker()
+        root = Host.create_new('host', None).add_root(self.root, session)
+        entries = [Server(ip='localhost', port=0, request=root.add_file(name, None, datetime.now(), 1))
+                   for name in ('a', 'missing')]
+        session.add_all(entries)
+        session.commit()
+        self.server_id, self.missing_id = (entry.id for entry in entries)
+        session.close()
+        self.server = self.start_server(session_maker)
+
+    @staticmethod
+    def start_server(session_maker):
+        tcp_server = server.ThreadedTCPServer(('localhost', 0), server.TCPRequestHandler)
+        tcp_server.session_maker = session_maker
+        Thread(target=tcp_server.serve_forever, daemon=True).start()
+        return tcp_server
+
+    def test_serve_file(self):
+        ip, port = self.server.server_address
+        self.assertEqual(hasher.calculate_hash(ip, port, self.server_id), {'md5': md5(self.data).hexdigest()})
+
+    def fetch(self, request):
+        sock = socket.create_connection(self.server.server_address)
+        try:
+            sock.sendall(('%s\n' % request).encode('ascii'))
+            with sock.makefile('rb') as stream:
+                return stream.read()
+        finally:
+            sock.close()
+
+    def hashes(self, server_ids, digest=False):
+        ip, port = self.server.server_address
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(hasher.calculate_hashes_async(ip, port, server_ids, digest=digest))
+        finally:
+            loop.close()
+
+    def test_serve_range(self):
+        self.assertEqual(self.fetch('%s 1000 5000' % self.server_id), self.data[1000:6000])
+
+    def test_serve_empty_range(self):
+        self.assertEqual(self.fetch('%s 1000 0' % self.server_id), bytes())
+
+    def test_send_empty_file(self):
+        path = os.path.join(self.root, 'empty')
+        open(path, 'wb').close()
+        sender, receiver = socket.socketpair()
+        try:
+            with open(path, 'rb') as file:
+                self.assertEqual(server.send_file(sender, file), 0)
+                self.assertEqual(server.send_file(sender, file, 0, 0), 0)
+            sender.close()
+            self.assertEqual(receiver.recv(10), bytes())
+        finally:
+            sender.close()
+            receiver.close()
+
+    def test_pipelined(self):
+        hashes = self.hashes([self.server_id, self.missing_id])
+        self.assertEqual(hashes, {self.server_id: {'md5': md5(self.data).hexdigest()}, self.missing_id: None})
+
+    def test_pipelined_digest(self):
+        hashes = self.hashes([self.server_id, self.missing_id], digest=True)
+        self.assertEqual(hashes, {self.server_id: {'md5': md5(self.data).hexdigest()}, self.missing_id: None})
+
+    def test_blocks(self):
+        _hash = hasher.MultiHash(('md5', ), block_size=40000)
+        for offset in range(0, len(self.data), 30000):
+            _hash.update(self.data[offset:offset + 30000])
+        self.assertEqual(_hash.hexdigests().blocks,
+                         [(offset, size, md5(self.data[offset:offset + size]).hexdigest())
+                          for offset, size in ((0, 40000), (40000, 40000), (80000, 20000))])
+
+    def test_default_blocks(self):
+        block_size = hasher.BLOCK_SIZE
+        hasher.BLOCK_SIZE = 40000
+        try:
+            self.assertEqual(len(hasher.calculate_local_hash(os.path.join(self.root, 'a'), ('md5', )).blocks), 3)
+        finally:
+            hasher.BLOCK_SIZE = block_size
+        self.assertEqual(hasher.calculate_local_hash(os.path.join(self.root, 'a'), ('md5', ), 0).blocks, [])
+
+    def test_digest_blocks(self):
+        blocks = [(0, 40000, 'x'), (40000, 100, 'y')]
+        digests, parsed = protocol.parse_digests(protocol.format_digests(OrderedDict(md5='a', sha1='b'), blocks))
+        self.assertEqual(list(digests.items()), [('md5', 'a'), ('sha1', 'b')])
+        self.assertEqual(parsed, blocks)
+
+    def test_tree_blocks(self):
+        leaf_size = hasher.TREE_LEAF_SIZE
+        hasher.TREE_LEAF_SIZE = 40000
+        try:
+            _hash = hasher.MultiHash((hasher.TREE_ALGORITHM, ))
+            _hash.update(self.data)
+            leaves = [(size, blake2b(self.data[offset:offset + size]).digest())
+                      for offset, size in ((0, 40000), (40000, 40000), (80000, 20000))]
+            self.assertEqual(_hash.hexdigests().blocks, hasher._leaf_blocks(leaves))
+        finally:
+            hasher.TREE_LEAF_SIZE = leaf_size
+
+    def test_parallel_hash(self):
+        leaf_size, parallel_range = hasher.TREE_LEAF_SIZE, hasher.PARALLEL_RANGE
+        hasher.TREE_LEAF_SIZE, hasher.PARALLEL_RANGE = 7000, 21000
+        try:
+            with ThreadPoolExecutor(4) as pool:
+                hashes = hasher.calculate_parallel_hash(os.path.join(self.root, 'a'), pool)
+            sequential = hasher.calculate_local_hash(os.path.join(self.root, 'a'), [hasher.TREE_ALGORITHM])
+            self.assertEqual(hashes, sequential)
+            self.assertEqual(hashes.blocks, sequential.blocks)
+            self.assertEqual(len(hashes.blocks), 15)
+        finally:
+            hasher.TREE_LEAF_SIZE, hasher.PARALLEL_RANGE = leaf_size, parallel_range
+
+    def test_multiple_digests(self):
+        digests = hasher.calculate_local_hash(os.path.join(self.root, 'a'), ('blake2b', 'md5'))
+        self.assertEqual(list(digests.items()), [('blake2b', blake2b(self.data).hexdigest()),
+                                                 ('md5', md5(self.data).hexdigest())])
+
+    def tearDown(self):
+        self.server.shutdown()
+        if hasattr(self.server, 'server_close'):
+            self.server.server_close()
+        os.remove(self.tempfile)
+
+
+class AsyncServerTest(ServerTest):
+    @staticmethod
+    def start_server(session_maker):
+        async_server = server.AsyncServer(session_maker, limit=2)
+        async_server.start('localhost', 0)
+        return async_server
+
+    def test_concurrent_connections(self):
+        ip, port = self.server.server_address
+        results = list()
+        threads = [Thread(target=lambda: results.append(hasher.calculate_hash(ip, port, self.server_id)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [{'md5': md5(self.data).hexdigest()}] * 5)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,219 @@
+# coding=utf-8
+"""
+Watches a directory tree with inotify and reports the directories whose content changed,
+bursts of events are coalesced per directory. Linux only, the inotify calls are made with ctypes.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+from select import select
+import struct
+import threading
+import time
+
+
+__author__ = 'konsti'
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONTFOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+# The events that change the content of the watched directory or the files in it
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | \
+    IN_MOVE_SELF | IN_ONLYDIR | IN_DONTFOLLOW
+
+# struct inotify_event without the name that follows it
+EVENT = struct.Struct('iIII')
+
+_libc = None
+
+
+def _inotify():
+    """
+    @return: the libc with the inotify functions
+    @raise OSError: if inotify is not available
+    """
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(name, use_errno=True) if name else None
+        if libc is None or not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        _libc = libc
+    return _libc
+
+
+def available():
+    """
+    @return: True if inotify can be used on this system
+    """
+    try:
+        _inotify()
+    except OSError:
+        return False
+    return True
+
+
+class Watcher(object):
+    """
+    Watches every directory below root and calls callback once per changed directory,
+    after there were no events for it for delay seconds or at most max_delay seconds after its first event.
+    @param root: the path of the root directory
+    @param callback: called with the path of a changed directory, from the watcher thread
+    @param delay: seconds without events until a directory is reported
+    @param max_delay: seconds after the first event until a directory is reported even if events keep coming
+    """
+
+    def __init__(self, root, callback, delay=2.0, max_delay=30.0):
+        self.root = root
+        self.callback = callback
+        self.delay = delay
+        self.max_delay = max_delay
+        self.alive = False
+        self._fd = None
+        self._paths = dict()
+        self._dirty = dict()
+        self._overflowed = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Watches the tree and starts the watcher thread
+        @return: False if inotify is not available or the watch limit was hit, the tree has to be polled then
+        """
+        try:
+            self._fd = _inotify().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if self._fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            self._watch_tree(self.root)
+        except OSError as e:
+            logger.warning('Can not watch %s: %s' % (self.root, e))
+            self._close()
+            return False
+        self.alive = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info('Watching %s directories below %s' % (len(self._paths), self.root))
+        return True
+
+    def stop(self):
+        """
+        Stops the watcher thread and releases the watches
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._close()
+
+    def needs_walk(self):
+        """
+        @return: True once after the event queue overflowed, events were lost and the tree has to be walked
+        """
+        with self._lock:
+            overflowed, self._overflowed = self._overflowed, False
+        return overflowed
+
+    def _close(self):
+        self.alive = False
+        if self._fd is not None and self._fd >= 0:
+            os.close(self._fd)
+        self._fd = None
+        self._paths.clear()
+
+    def _watch_tree(self, path):
+        """
+        @param path: the path of a directory that is watched together with all directories below it
+        @raise OSError: with errno ENOSPC if the watch limit was hit
+        """
+        for directory, _, _ in os.walk(path):
+            wd = _inotify().inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, 'The inotify watch limit was hit, see /proc/sys/fs/inotify/max_user_watches')
+                # it vanished in the meantime, its parent reports that
+                logger.debug('Can not watch %s: %s' % (directory, os.strerror(error)))
+                continue
+            self._paths[wd] = directory
+
+    def _loop(self):
+        """
+        Reads the events and reports the changed directories until stop is called
+        """
+        while not self._stop.is_set():
+            readable, _, _ = select([self._fd], [], [], self.delay / 2)
+            if readable:
+                try:
+                    data = os.read(self._fd, 2 ** 16)
+                except BlockingIOError:
+                    data = bytes()
+                try:
+                    self._handle(data)
+                except OSError as e:
+                    logger.warning('Stopped watching %s, falling back to walking it: %s' % (self.root, e))
+                    with self._lock:
+                        self._overflowed = True
+                    self._close()
+                    return
+            self._report()
+
+    def _handle(self, data):
+        """
+        @param data: raw inotify events
+        """
+        now = time.time()
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('The inotify event queue of %s overflowed' % self.root)
+                with self._lock:
+                    self._overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            directory = self._paths.get(wd)
+            if directory is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # the parent of a removed or moved directory reports it
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(os.path.join(directory, os.fsdecode(name)))
+            first, _ = self._dirty.get(directory, (now, now))
+            self._dirty[directory] = (first, now)
+
+    def _report(self):
+        """
+        Calls the callback for the directories that were quiet for delay seconds or are dirty for max_delay seconds
+        """
+        now = time.time()
+        for directory, (first, last) in list(self._dirty.items()):
+            if now - last >= self.delay or now - first >= self.max_delay:
+                del self._dirty[directory]
+                try:
+                    self.callback(directory)
+                except Exception as e:
+                    logger.exception(e)